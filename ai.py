@@ -1,143 +1,2393 @@
-import requests
+from __future__ import annotations
+
+import csv
 import json
+import struct
+import mmap
+import hashlib
+import html
 import asyncio
-import edge_tts
+import codecs
+import importlib
+import math
 import time
 import re
 import os
-from typing import Optional, Dict, Any
+import sys
+import io
+import wave
+import uuid
+import shutil
+import atexit
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+from array import array
+from collections import OrderedDict, Counter, deque
+from contextlib import nullcontext, asynccontextmanager
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple, Union, Iterable, Callable, AsyncIterator
 from urllib.parse import quote_plus
 from datetime import datetime, timezone, timedelta
 
+
+class _LazyModule:
+    """Stands in for a module and imports it on first attribute access
+
+    Keeps `import ai` cheap for text-only use; submodules (aiohttp.web)
+    are imported on demand too.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        try:
+            value = getattr(self._module, attr)
+        except AttributeError:
+            value = importlib.import_module(f"{self._name}.{attr}")
+        setattr(self, attr, value)
+        return value
+
+
+requests = _LazyModule("requests")
+aiohttp = _LazyModule("aiohttp")
+edge_tts = _LazyModule("edge_tts")
+np = _LazyModule("numpy")
+
+
+SENTENCE_END = re.compile(r'([.!?]+["\')\]]*)\s+')
+
+SYSTEM_PROMPT = "You are Testudo, an ai enabled pet like companion. Designed as an turtle. Reply in 1–2 short natural sentences. Avoid emoticons or roleplay stage directions. Don't call people 'friend', 'creator', or other names unless you know their actual name from the conversation. Never use asterisks for actions or movements."
+
+TIME_KEYWORDS = ["what time", "what's the time", "current time", "time is it",
+                 "what date", "what's the date", "current date", "date today",
+                 "today", "now", "current", "when is it"]
+
+# Day and date questions without a time keyword, for the router's clock intent
+CLOCK_PATTERNS = [r"\bwhat (?:day|month|year) is (?:it )?today\b",
+                  r"\bwhat (?:day|month|year) is it\b(?! (?:tomorrow|yesterday|on|in)\b)",
+                  r"\btoday'?s date\b",
+                  r"\bwhat day of the (?:week|month) is it\b"]
+
+UNKNOWN_PHRASES = ["not in my codebase", "don't know", "i don't know", "not sure", "i'm not sure",
+                   "can't help", "don't have information", "not familiar", "i don't have",
+                   "beyond my knowledge", "i cannot", "i can't", "no information", "not aware",
+                   "i'm not aware"]
+
+W_WORDS = ("who", "what", "when", "where", "why", "which")
+
+PROMPT_LAYOUTS = ("classic", "stable")
+
+SEARCH_POLICIES = ("sequential", "speculative", "search-first")
+
+DEVICE_SAMPLE_RATE = 16000  # playWav in serverer.ino: 8-bit unsigned mono PCM after a 44 byte header
+
+NOT_NAMES = {'happy', 'sad', 'tired', 'good', 'fine', 'okay', 'great', 'studying', 'working', 'here', 'back', 'done'}
+
+JOB_WORDS = ['student', 'teacher', 'doctor', 'engineer', 'programmer', 'developer', 'designer', 'writer', 'artist', 'lawyer', 'nurse', 'manager']
+
+SEARCH_URL = "https://www.google.com/search"
+
+LM_STUDIO_URL = os.environ.get("TESTUDO_LM_URL", "http://localhost:1234")  # comma separated for several
+
+STOPWORDS = frozenset("""a an the is are was were be been am do does did of in on at to for from by with and or
+not it its this that these those i you he she we they me my your our their what who whom whose when where
+why which how there here as into than then so if can could would should will shall may might must has have
+had about tell please know""".split())
+
+SNIPPET_SKIP = ['search', 'more', 'about', 'sign in', 'images']
+
+SEARCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+
+log = logging.getLogger("testudo")
+
+
+class StructuredFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message and any extra= fields"""
+
+    STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": round(record.created, 3), "level": record.levelname.lower(),
+                 "logger": record.name, "msg": record.getMessage()}
+        entry.update({k: v for k, v in vars(record).items() if k not in self.STANDARD})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = "INFO", json_lines: Optional[bool] = None):
+    """Send testudo logs to stderr, as plain text or JSON lines (TESTUDO_LOG_JSON=1)"""
+    if json_lines is None:
+        json_lines = os.environ.get("TESTUDO_LOG_JSON", "0") == "1"
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter() if json_lines else logging.Formatter("%(message)s"))
+    log.handlers[:] = [handler]
+    log.setLevel(os.environ.get("TESTUDO_LOG_LEVEL", level))
+    log.propagate = False
+
+
+class _NoSpan:
+    """Shared do-nothing span handed out while metrics are off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span:
+    """Times one pipeline stage; usable with 'with' and 'async with'"""
+
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics: "Metrics", stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, failed=exc_type is not None)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+class Metrics:
+    """Per-stage latency histograms and counters for the chat pipeline
+
+    Latencies keep the last `window` samples per stage for p50/p95/p99 plus
+    running count/sum. With enabled=False (or TESTUDO_METRICS=0) span()
+    returns a shared no-op object and count() returns at once.
+    """
+
+    def __init__(self, enabled: bool = True, window: int = 2048):
+        self.enabled = enabled
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples: Dict[str, deque] = {}
+        self.totals: Dict[str, List[float]] = {}
+        self.counters: Dict[str, int] = {}
+
+    def span(self, stage: str):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, stage)
+
+    def observe(self, stage: str, seconds: float, failed: bool = False):
+        if not self.enabled:
+            return
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.window)
+                self.totals[stage] = [0, 0.0, 0]
+            samples.append(seconds)
+            totals = self.totals[stage]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += failed
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"{stage} took {seconds * 1000:.1f} ms",
+                      extra={"stage": stage, "ms": round(seconds * 1000, 2), "failed": failed})
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def percentiles(self, stage: str) -> Dict[str, float]:
+        with self.lock:
+            values = np.array(self.samples.get(stage, ()), dtype=np.float64)
+        if len(values) == 0:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Everything as plain data, for the JSON dump"""
+        with self.lock:
+            totals = {stage: list(values) for stage, values in self.totals.items()}
+        stages = {}
+        for stage in sorted(totals):
+            count, total, failed = totals[stage]
+            stages[stage] = {"count": count, "sum": total, "failed": failed, **self.percentiles(stage)}
+        with self.lock:
+            counters = dict(sorted(self.counters.items()))
+        return {"enabled": self.enabled, "stages": stages, "counters": counters}
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = ["# HELP testudo_stage_seconds Latency of each chat pipeline stage",
+                 "# TYPE testudo_stage_seconds summary"]
+        for stage, values in snapshot["stages"].items():
+            for quantile in ("p50", "p95", "p99"):
+                q = int(quantile[1:]) / 100
+                lines.append(f'testudo_stage_seconds{{stage="{stage}",quantile="{q}"}} {values[quantile]:.6f}')
+            lines.append(f'testudo_stage_seconds_sum{{stage="{stage}"}} {values["sum"]:.6f}')
+            lines.append(f'testudo_stage_seconds_count{{stage="{stage}"}} {values["count"]}')
+        for name, value in snapshot["counters"].items():
+            lines.append(f"# TYPE testudo_{name}_total counter")
+            lines.append(f"testudo_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """Write the JSON snapshot to a file"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.totals.clear()
+            self.counters.clear()
+
+
+METRICS = Metrics(enabled=os.environ.get("TESTUDO_METRICS", "1") != "0")
+
+
+def _phrases(phrases: Iterable[str]) -> str:
+    """Regex alternation of literal phrases, longest first"""
+    return "|".join(re.escape(p) for p in sorted(set(phrases), key=len, reverse=True))
+
+
+class MessageMatcher:
+    """Precompiled single pass over a message for personal info and intents
+
+    Every cue sits in a zero-width lookahead, so one finditer visits each
+    place something starts and nothing hides a later cue. Where two cues
+    start at the same spot the more specific branch wins ("i'm a teacher"
+    is a job, "i'm from rome" a location, "i'm not sure" an unknown).
+    """
+
+    WORDS = r"[a-z][a-z\s]*"
+
+    def __init__(self,
+                 time_keywords: Iterable[str] = TIME_KEYWORDS,
+                 unknown_phrases: Iterable[str] = UNKNOWN_PHRASES,
+                 cache_size: int = 512):
+        words = self.WORDS
+        branches = [
+            rf"\b(?:i am|i'm)\s+(?P<age>\d+)",
+            rf"\b(?P<age_b>\d+)\s+years?\s+old",
+            rf"\b(?:my name is|call me|i'm called|i am called)\s+(?P<name>{words})",
+            rf"\b(?:i live in|i'm from|i am from|i'm in|i am in)\s+(?P<location>{words})",
+            rf"\b(?:i work as an?|i'm an?|i am an?|my job is)\s+(?P<occupation>{words})",
+            rf"\b(?P<unknown>{_phrases(unknown_phrases)})",
+            rf"\b(?:i am|i'm)\s+(?P<name_b>{words})",
+            rf"\b(?P<time>{_phrases(time_keywords)})\b",
+        ]
+        self.pattern = re.compile("(?=" + "|".join(branches) + ")")
+        self._cached = lru_cache(maxsize=cache_size)(self._match)
+
+    def match(self, message: str) -> Dict[str, Any]:
+        """Everything found in message; a copy, so callers can't change the cached result"""
+        return dict(self._cached(message))
+
+    def _match(self, message: str) -> Dict[str, Any]:
+        text = message.lower().strip()
+        found: Dict[str, Any] = {
+            "time": False,
+            "unknown": False,
+            "w_question": text.startswith(W_WORDS),
+        }
+
+        for match in self.pattern.finditer(text):
+            group = match.lastgroup
+            value = match.group(group)
+            kind = group.split("_")[0]
+
+            if kind in ("time", "unknown"):
+                found[kind] = True
+            elif kind in found:
+                continue
+            elif kind == "age":
+                age = int(value)
+                if 1 <= age <= 120:
+                    found["age"] = age
+            elif kind == "name":
+                name = value.strip().title()
+                if name.lower() not in NOT_NAMES and len(name) > 1:
+                    found["name"] = name
+            elif kind == "location":
+                location = value.strip().title()
+                if len(location) > 1:
+                    found["location"] = location
+            elif kind == "occupation":
+                job = value.strip().title()
+                if any(word in job.lower() for word in JOB_WORDS) or len(job.split()) <= 3:
+                    found["occupation"] = job
+
+        return found
+
+    def personal_info(self, message: str) -> Dict[str, Any]:
+        """name / age / location / occupation found in message"""
+        found = self.match(message)
+        return {key: found[key] for key in ("name", "age", "location", "occupation") if key in found}
+
+    def extract_batch(self, messages: Iterable[str]) -> List[Dict[str, Any]]:
+        """Full match result for every message of a transcript"""
+        cached = self._cached
+        return [dict(cached(message)) for message in messages]
+
+
+MATCHER = MessageMatcher()
+
+
+# Whole-question patterns: "who am i talking to?" or "how old am i going to be in 2030?" go to the LLM
+PROFILE_INTENTS = {
+    "name": (r"^\W*(?:what(?:'s| is) my name|do you (?:know|remember) my name|who am i)\W*$",
+             "Your name is {name}!",
+             "I don't know your name yet. What should I call you?"),
+    "age": (r"^\W*(?:how old am i|what(?:'s| is) my age|do you (?:know|remember) (?:my age|how old i am))\W*$",
+            "You're {age} years old.",
+            "You haven't told me how old you are yet."),
+    "location": (r"^\W*(?:where do i live|where am i from|where(?:'s| is) my home|do you (?:know|remember) where i live)\W*$",
+                 "You live in {location}.",
+                 "You haven't told me where you live yet."),
+    "occupation": (r"^\W*(?:what(?:'s| is) my (?:job|occupation|profession|work)|what do i do for (?:a )?(?:living|work)"
+                   r"|where do i work|what do i work as)\W*$",
+                   "You work as {job}.",
+                   "You haven't told me what you do yet."),
+}
+
+
+class IntentRouter:
+    """Rule-based replies for questions that need no LLM
+
+    Profile lookups ("what's my name?", "how old am I?", "where do I
+    live?", "what's my job?") must be the whole question and are answered
+    from user_data; clock questions are answered from the local time, both
+    with templated replies. All intents are alternatives of one lookahead
+    regex, like MessageMatcher; where
+    several match, the one registered first wins (custom intents go ahead
+    of the built-ins unless first=False, and the broad time keywords come
+    last). A template is filled from the profile plus job, time, date and
+    now; if a field it needs is unknown the intent's missing reply is used,
+    or with none the message goes on to the LLM.
+    """
+
+    def __init__(self, tz: timezone = timezone(timedelta(hours=3)), tz_label: str = "Istanbul time"):
+        self.tz = tz
+        self.tz_label = tz_label
+        self.intents: List[Tuple[str, str, Union[str, Callable[[Dict[str, Any]], Optional[str]]], Optional[str]]] = []
+        self.hits: Counter = Counter()
+        self.routed = 0
+        self.passed = 0
+        for name, (pattern, reply, missing) in PROFILE_INTENTS.items():
+            self.register(name, pattern, reply, missing, first=False)
+        # Multi-word cues only: a bare "today" or "now" ("my work schedule today") is not a clock question
+        clock = [keyword for keyword in TIME_KEYWORDS if " " in keyword]
+        self.register("time", [rf"\b(?:{_phrases(clock)})\b", *CLOCK_PATTERNS], "It's currently {now}.",
+                      first=False)
+
+    def register(self,
+                 name: str,
+                 patterns: Union[str, Iterable[str]],
+                 reply: Union[str, Callable[[Dict[str, Any]], Optional[str]]],
+                 missing: Optional[str] = None,
+                 first: bool = True):
+        """Add an intent: regexes over the lowercased message and a template or fields -> reply callable"""
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        intent = (name, "|".join(f"(?:{p})" for p in patterns), reply, missing)
+        self.intents = [i for i in self.intents if i[0] != name]
+        if first:
+            self.intents.insert(0, intent)
+        else:
+            self.intents.append(intent)
+        self._compile()
+
+    def remove(self, name: str):
+        """Drop an intent, built-in or custom; its questions go to the LLM again"""
+        self.intents = [i for i in self.intents if i[0] != name]
+        self._compile()
+
+    def _compile(self):
+        branches = "|".join(f"(?P<i{n}>{i[1]})" for n, i in enumerate(self.intents))
+        self.pattern = re.compile(f"(?={branches})" if branches else "(?!)")
+
+    def fields(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Template fields: the profile plus job (with an article), time, date and now"""
+        now = datetime.now(self.tz)
+        fields = {key: value for key, value in user_data.items() if value not in (None, "")}
+        fields.update(time=now.strftime("%H:%M"), date=now.strftime("%A, %B %d, %Y"),
+                      now=now.strftime(f"%A, %B %d, %Y at %H:%M ({self.tz_label})"))
+        if "occupation" in fields:
+            job = str(fields["occupation"]).lower()
+            fields["job"] = f"{'an' if job[:1] in 'aeiou' else 'a'} {job}"
+        return fields
+
+    def match(self, message: str) -> Optional[str]:
+        """Name of the highest-priority intent in message, or None"""
+        matched = [int(m.lastgroup[1:]) for m in self.pattern.finditer(message.lower())]
+        return self.intents[min(matched)][0] if matched else None
+
+    def route(self, message: str, user_data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        """(intent, reply) when the message can be answered locally, else None"""
+        intent = self.match(message)
+        if intent is None:
+            self.passed += 1
+            return None
+        _, _, reply, missing = next(i for i in self.intents if i[0] == intent)
+        fields = self.fields(user_data)
+        try:
+            text = reply(fields) if callable(reply) else reply.format(**fields)
+        except KeyError:
+            text = missing
+        if not text:
+            self.passed += 1
+            return None
+        self.routed += 1
+        self.hits[intent] += 1
+        return intent, text
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.routed + self.passed
+        return {"deflected": self.routed, "passed": self.passed, "intents": dict(self.hits),
+                "deflection_rate": self.routed / total if total else 0.0}
+
+
+_default_intents: Optional[IntentRouter] = None
+
+
+def default_intent_router() -> IntentRouter:
+    """Module wide router with the built-in intents, used by quick_chat"""
+    global _default_intents
+    if _default_intents is None:
+        _default_intents = IntentRouter()
+    return _default_intents
+
+
+def normalize_query(query: str) -> str:
+    """Cache key for a question: lowercase words without punctuation"""
+    return " ".join(re.sub(r"[^\w\s']", " ", query.lower()).split())
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token) without a tokenizer"""
+    return len(text) // 4 + 1
+
+
+def summarize_turns(summary: Optional[str], turns: List[Dict[str, str]]) -> str:
+    """Fold old turns into the running summary by keeping the first clause the user said"""
+    said = [re.split(r'[.!?,;]', turn["content"], maxsplit=1)[0].strip()[:80]
+            for turn in turns if turn["role"] == "user"]
+    said = [part for part in said if part]
+    if not said:
+        return summary or ""
+    earlier = summary[len("Earlier the user said: "):].rstrip(".") if summary else ""
+    parts = [p for p in earlier.split("; ") if p] + said
+    return "Earlier the user said: " + "; ".join(parts) + "."
+
+
+class ConversationMemory:
+    """Bounded conversation history with a token-budgeted context window
+
+    Messages live in a ring buffer of max_messages. window() returns the
+    newest whole exchanges that fit in max_tokens, so prompt size stays
+    predictable however long the messages are. With summarize=True the
+    turns that fall out of the window are folded into one short summary
+    message instead of being forgotten.
+
+    With block > 1 the window start (and folding) moves block exchanges
+    at a time, so for most turns the prompt only grows at the end and the
+    backend can reuse its cached prefix.
+    """
+
+    def __init__(self,
+                 max_messages: int = 40,
+                 max_tokens: int = 512,
+                 summarize: bool = False,
+                 summary_tokens: int = 96,
+                 count_tokens: Callable[[str], int] = estimate_tokens,
+                 summarizer: Callable[[Optional[str], List[Dict[str, str]]], str] = summarize_turns,
+                 block: int = 1):
+        self.max_tokens = max_tokens
+        self.block = block
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.count_tokens = count_tokens
+        self.summarizer = summarizer
+        self.messages: deque = deque(maxlen=max_messages)
+        self.tokens: deque = deque(maxlen=max_messages)
+        self.summary: Optional[str] = None
+        self.added = 0
+        self.anchor = 0
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def add(self, role: str, content: str):
+        if self.summarize and len(self.messages) == self.messages.maxlen:
+            self._fold(2 * self.block)
+        self.messages.append({"role": role, "content": content})
+        self.tokens.append(self.count_tokens(content) + 4)
+        self.added += 1
+
+    def add_exchange(self, prompt: str, reply: str):
+        self.add("user", prompt)
+        self.add("assistant", reply)
+        if self.summarize:
+            while len(self.messages) > 2 and sum(self.tokens) + self._summary_cost() > self.max_tokens:
+                self._fold(min(2 * self.block, len(self.messages) - 2))
+            if sum(self.tokens) + self._summary_cost() > self.max_tokens:
+                self.summary = self._fitted_summary(self.max_tokens - sum(self.tokens))
+
+    def _summary_cost(self) -> int:
+        return self.count_tokens(self.summary) + 4 if self.summary else 0
+
+    def _fold(self, count: int):
+        """Move the oldest messages into the summary"""
+        old = [self.messages.popleft() for _ in range(min(count, len(self.messages)))]
+        for _ in old:
+            self.tokens.popleft()
+        summary = self._trimmed(self.summarizer(self.summary, old), self.summary_tokens)
+        self.summary = summary or None
+
+    def _trimmed(self, summary: Optional[str], limit: int) -> Optional[str]:
+        """Drop the oldest clauses until the summary is at most limit tokens (or one clause is left)"""
+        while summary and self.count_tokens(summary) > limit and "; " in summary:
+            summary = "Earlier the user said: " + summary.split("; ", 1)[1]
+        return summary
+
+    def _fitted_summary(self, limit: int) -> Optional[str]:
+        """The summary cut down to cost at most limit tokens, or None if even one clause is too long"""
+        summary = self._trimmed(self.summary, limit - 4)
+        if summary and self.count_tokens(summary) + 4 <= limit:
+            return summary
+        return None
+
+    def window(self) -> List[Dict[str, str]]:
+        """Newest whole exchanges that fit in the token budget, after the summary
+
+        The summary never pushes out the newest exchange: it is trimmed
+        (or left out) to fit next to it.
+        """
+        summary = self._fitted_summary(self.max_tokens - sum(list(self.tokens)[-2:]))
+        budget = self.max_tokens - (self.count_tokens(summary) + 4 if summary else 0)
+        head = [{"role": "system", "content": summary}] if summary else []
+        if self.block > 1:
+            return head + self._blocked_window(budget)
+
+        start = len(self.messages)
+        used = 0
+        while start >= 2:
+            cost = self.tokens[start - 1] + self.tokens[start - 2]
+            if used + cost > budget:
+                break
+            used += cost
+            start -= 2
+        return head + list(self.messages)[start:]
+
+    def _blocked_window(self, budget: int) -> List[Dict[str, str]]:
+        """Messages from the anchor on, moving the anchor a block at a time when over budget
+
+        A whole-block jump that would cut into the newest exchange falls
+        back to dropping one exchange at a time, so long exchanges never
+        empty the window.
+        """
+        first = self.added - len(self.messages)
+        start = max(self.anchor, first) - first
+        tokens = list(self.tokens)
+        used = sum(tokens[start:])
+        while used > budget and start < len(tokens):
+            step = 2 * self.block if start + 2 * self.block <= len(tokens) - 2 else 2
+            step = min(step, len(tokens) - start)
+            used -= sum(tokens[start:start + step])
+            start += step
+        self.anchor = first + start
+        return list(self.messages)[start:]
+
+    def clear(self):
+        self.messages.clear()
+        self.tokens.clear()
+        self.summary = None
+        self.anchor = self.added
+
+
+def write_json(path: str, data: Any):
+    """Write JSON atomically through a uniquely named temp file, so concurrent writers never share one"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class SearchCache:
+    """TTL + LRU cache of search answers, kept on disk between runs
+
+    A None answer is cached too (for a shorter negative_ttl) so questions
+    Google has no snippet for don't hit the network every time either.
+    Changes are written by a timer thread at most every save_interval
+    seconds (and at exit), so store() never touches the disk and is safe
+    to call from the event loop.
+    """
+
+    def __init__(self,
+                 path: Optional[str] = "search_cache.json",
+                 ttl: float = 7 * 24 * 3600,
+                 negative_ttl: float = 3600,
+                 max_entries: int = 1000,
+                 max_bytes: int = 512 * 1024,
+                 save_interval: float = 2.0):
+        self.path = path
+        self.save_interval = save_interval
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._timer: Optional[threading.Timer] = None
+        self.load()
+        if path:
+            atexit.register(self.flush)
+
+    @staticmethod
+    def _entry_size(key: str, answer: Optional[str]) -> int:
+        return len(key.encode('utf-8')) + len((answer or "").encode('utf-8'))
+
+    def key(self, query: str) -> str:
+        return normalize_query(query)
+
+    def lookup(self, query: str) -> Tuple[bool, Optional[str]]:
+        """(found, answer) for query; found with a None answer is a cached miss"""
+        key = self.key(query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.time():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[0]
+
+    def store(self, query: str, answer: Optional[str]):
+        """Remember the answer (or the lack of one) for query"""
+        key = self.key(query)
+        ttl = self.ttl if answer is not None else self.negative_ttl
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (answer, time.time() + ttl)
+            self.size += self._entry_size(key, answer)
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        self._changed()
+
+    def _drop(self, key: str):
+        answer, _ = self.entries.pop(key)
+        self.size -= self._entry_size(key, answer)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        self._changed()
+
+    def _changed(self):
+        """Schedule a save in save_interval seconds unless one is pending"""
+        if not self.path:
+            return
+        with self.lock:
+            self._dirty = True
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.save_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Write pending changes now"""
+        with self.lock:
+            timer, self._timer = self._timer, None
+            dirty, self._dirty = self._dirty, False
+        if timer is not None:
+            timer.cancel()
+        if dirty:
+            self.save()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters, to check repeat questions skip the network"""
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+    def load(self):
+        """Read unexpired entries from disk, oldest first"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except Exception as e:
+            log.error(f"Error loading search cache: {e}")
+            return
+
+        now = time.time()
+        for key, answer, expires in stored:
+            if expires > now:
+                self.entries[key] = (answer, expires)
+                self.size += self._entry_size(key, answer)
+
+    def save(self):
+        """Write the cache atomically (temp file + rename)"""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self.lock:
+                stored = [[key, answer, expires] for key, (answer, expires) in self.entries.items()]
+            try:
+                write_json(self.path, stored)
+            except Exception as e:
+                log.error(f"Error saving search cache: {e}")
+
+
+_default_search: Optional[SearchCache] = None
+
+
+def default_search_cache() -> SearchCache:
+    """Module wide search cache on search_cache.json, shared by every TestudoAI"""
+    global _default_search
+    if _default_search is None:
+        _default_search = SearchCache()
+    return _default_search
+
+
+class ResponseCache(SearchCache):
+    """Exact-match cache of LLM replies keyed on the whole completion request
+
+    The key hashes the model, system prompt with user context, history
+    window and prompt, so a hit is a reply to the very same request.
+    Memory only unless a path is given.
+    """
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 ttl: float = 24 * 3600,
+                 max_entries: int = 500,
+                 max_bytes: int = 256 * 1024):
+        super().__init__(path=path, ttl=ttl, negative_ttl=0,
+                         max_entries=max_entries, max_bytes=max_bytes)
+
+    def key(self, payload: Dict[str, Any]) -> str:
+        request = {k: v for k, v in payload.items() if k != "stream"}
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def lookup(self, payload: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+        found, reply = super().lookup(payload)
+        METRICS.count("response_cache_hits" if found else "response_cache_misses")
+        if found:
+            log.debug(f"💾 Cached reply: {reply}")
+        return found, reply
+
+    def store(self, payload: Dict[str, Any], reply: Optional[str]):
+        if reply:
+            super().store(payload, reply)
+
+
+_default_replies: Optional[ResponseCache] = None
+
+
+def default_response_cache() -> ResponseCache:
+    """Module wide in-memory reply cache used by quick_chat"""
+    global _default_replies
+    if _default_replies is None:
+        _default_replies = ResponseCache()
+    return _default_replies
+
+
+class ModelCache:
+    """Each LM Studio's /v1/models listing with a TTL, kept on disk between runs
+
+    A fresh entry answers check_connection without a round trip. A stale
+    one is still used, and TestudoAI refreshes it in the background.
+    """
+
+    def __init__(self, path: Optional[str] = "model_cache.json", ttl: float = 300):
+        self.path = path
+        self.ttl = ttl
+        self.entries: Dict[str, Tuple[List[str], float]] = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.load()
+
+    def get(self, url: str) -> Tuple[Optional[List[str]], bool]:
+        """(model ids or None, still fresh) for the server at url"""
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is None:
+            return None, False
+        models, fetched = entry
+        return models, time.time() - fetched < self.ttl
+
+    def store(self, url: str, models: List[str]):
+        with self.lock:
+            self.entries[url] = (models, time.time())
+            self.refreshing.discard(url)
+        self.save()
+
+    def forget(self, url: str):
+        with self.lock:
+            self.entries.pop(url, None)
+            self.refreshing.discard(url)
+        self.save()
+
+    def claim_refresh(self, url: str) -> bool:
+        """True for the one caller that should refresh url now"""
+        with self.lock:
+            if url in self.refreshing:
+                return False
+            self.refreshing.add(url)
+            return True
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            self.entries = {url: (models, fetched) for url, (models, fetched) in stored.items()}
+        except Exception as e:
+            log.error(f"Error loading model cache: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            stored = {url: [models, fetched] for url, (models, fetched) in self.entries.items()}
+        try:
+            write_json(self.path, stored)
+        except Exception as e:
+            log.error(f"Error saving model cache: {e}")
+
+
+_default_models: Optional[ModelCache] = None
+
+
+def default_model_cache() -> ModelCache:
+    """Module wide model listing cache shared by every TestudoAI"""
+    global _default_models
+    if _default_models is None:
+        _default_models = ModelCache()
+    return _default_models
+
+
+class UserStore:
+    """Profiles for many users in one SQLite file, one row per fact
+
+    Changes are queued in memory and written by a background thread every
+    flush_interval seconds in a single transaction, so the request path
+    never waits on disk. WAL mode keeps every flush atomic; the log is
+    checkpointed (compacted) every compact_every flushes.
+    """
+
+    def __init__(self,
+                 path: str = "user_data.db",
+                 flush_interval: float = 1.0,
+                 compact_every: int = 50):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.flushes = 0
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer: Optional[threading.Thread] = None
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS profiles (
+                               user_id TEXT NOT NULL,
+                               key TEXT NOT NULL,
+                               value TEXT NOT NULL,
+                               updated REAL NOT NULL,
+                               PRIMARY KEY (user_id, key)
+                           ) WITHOUT ROWID""")
+        atexit.register(self.close)
+
+    def load(self, user_id: str) -> Dict[str, Any]:
+        """One user's profile, including changes not flushed yet"""
+        with self.lock:
+            rows = self.db.execute("SELECT key, value FROM profiles WHERE user_id = ?", (user_id,)).fetchall()
+            data = {key: json.loads(value) for key, value in rows}
+            data.update(self.pending.get(user_id, {}))
+        return data
+
+    def update(self, user_id: str, changes: Dict[str, Any]):
+        """Queue changed fields for the background writer"""
+        if not changes:
+            return
+        with self.lock:
+            self.pending.setdefault(user_id, {}).update(changes)
+        self._start_writer()
+
+    def delete(self, user_id: str):
+        """Forget a user completely"""
+        with self.lock:
+            self.pending.pop(user_id, None)
+            self.db.execute("DELETE FROM profiles WHERE user_id = ?", (user_id,))
+
+    def user_ids(self) -> List[str]:
+        with self.lock:
+            rows = self.db.execute("SELECT DISTINCT user_id FROM profiles").fetchall()
+            return sorted({row[0] for row in rows} | set(self.pending))
+
+    def import_json(self, json_file: str, user_id: str) -> Dict[str, Any]:
+        """Move an old single-profile user_data.json into the store
+
+        The file is renamed to <file>.imported afterwards so it can never
+        be imported a second time.
+        """
+        with open(json_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.update(user_id, data)
+        self.flush()
+        os.replace(json_file, json_file + ".imported")
+        return data
+
+    def flush(self):
+        """Write all queued changes in one transaction"""
+        with self.lock, METRICS.span("store_flush"):
+            if not self.pending:
+                return
+            now = time.time()
+            rows = [(user_id, key, json.dumps(value, ensure_ascii=False), now)
+                    for user_id, changes in self.pending.items()
+                    for key, value in changes.items()]
+            try:
+                self.db.execute("BEGIN")
+                self.db.executemany("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?)", rows)
+                self.db.execute("COMMIT")
+            except Exception as e:
+                self.db.execute("ROLLBACK")
+                log.error(f"Error saving user data: {e}")
+                return
+            self.pending.clear()
+            self.flushes += 1
+            if self.flushes % self.compact_every == 0:
+                self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _start_writer(self):
+        if self._writer is None and not self._closed:
+            self._writer = threading.Thread(target=self._write_loop, name="testudo-user-store", daemon=True)
+            self._writer.start()
+        self._wake.set()
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wake.wait()
+            self._wake.clear()
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        """Flush and close the database"""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._wake.set()
+        with self.lock:
+            self.db.close()
+
+
+_user_stores: Dict[str, UserStore] = {}
+
+
+def open_user_store(path: str) -> UserStore:
+    """One shared UserStore per database file"""
+    path = os.path.abspath(path)
+    if path not in _user_stores:
+        _user_stores[path] = UserStore(path)
+    return _user_stores[path]
+
+
+class AudioCache:
+    """Content-addressed store of synthesized speech, evicted LRU by total bytes
+
+    Files are named by a hash of (voice, text), so one reply never
+    overwrites another and a repeated reply is just a path lookup.
+    """
+
+    def __init__(self,
+                 directory: str = "tts_cache",
+                 max_bytes: int = 64 * 1024 * 1024,
+                 extension: str = ".mp3"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.lock = threading.Lock()
+        self.index: "OrderedDict[str, int]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        files = []
+        for name in (os.listdir(directory) if os.path.isdir(directory) else []):
+            if name.endswith(extension):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name[:-len(extension)], stat.st_size))
+        for _, key, size in sorted(files):
+            self.index[key] = size
+            self.size += size
+
+    def key(self, voice: str, text: str) -> str:
+        return hashlib.sha256(f"{voice}\n{text}".encode('utf-8')).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.extension)
+
+    def temp_path(self) -> str:
+        """Unique scratch file inside the cache directory, for put_file
+
+        The directory is made here, on the first write, so text-only use
+        never leaves an empty tts_cache behind.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"{uuid.uuid4().hex}.part")
+
+    def has(self, voice: str, text: str) -> bool:
+        """Whether (voice, text) is cached, without counting a hit or miss"""
+        return self.key(voice, text) in self.index
+
+    def get(self, voice: str, text: str) -> Optional[str]:
+        """Path of cached audio for (voice, text), or None"""
+        key = self.key(voice, text)
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+            self.index.move_to_end(key)
+            self.hits += 1
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self._forget(key)
+            return None
+        return path
+
+    def get_bytes(self, voice: str, text: str) -> Optional[bytes]:
+        """Cached audio for (voice, text) as a buffer, or None"""
+        path = self.get(voice, text)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, voice: str, text: str, data: bytes) -> str:
+        """Store audio atomically and return its path"""
+        tmp_path = self.temp_path()
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return self.put_file(voice, text, tmp_path)
+
+    def put_file(self, voice: str, text: str, tmp_path: str) -> str:
+        """Move a finished file into the cache (rename, so readers never see half a file)"""
+        key = self.key(voice, text)
+        path = self.path_for(key)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self._forget(key)
+            self.index[key] = size
+            self.size += size
+            while self.size > self.max_bytes and len(self.index) > 1:
+                old_key = next(iter(self.index))
+                self._forget(old_key)
+                self.evictions += 1
+                try:
+                    os.remove(self.path_for(old_key))
+                except OSError:
+                    pass
+        return path
+
+    def _forget(self, key: str):
+        size = self.index.pop(key, None)
+        if size is not None:
+            self.size -= size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.index),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_default_audio: Optional[AudioCache] = None
+
+
+def default_audio_cache() -> AudioCache:
+    """Module wide audio cache used by chat_with_voice"""
+    global _default_audio
+    if _default_audio is None:
+        _default_audio = AudioCache()
+    return _default_audio
+
+
+class HttpClient:
+    """Long-lived pooled HTTP transport, with a blocking and an asyncio side"""
+
+    def __init__(self,
+                 pool_size: int = 10,
+                 per_host: int = 4,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 30.0,
+                 keepalive: float = 30.0):
+        self.pool_size = pool_size
+        self.per_host = per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive = keepalive
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=per_host, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._async_session: Optional[aiohttp.ClientSession] = None
+        self._async_loop = None
+
+    def timeout(self, read: Optional[float] = None) -> tuple:
+        """(connect, read) timeout for the blocking session"""
+        return (self.connect_timeout, read or self.read_timeout)
+
+    def async_timeout(self, read: Optional[float] = None) -> aiohttp.ClientTimeout:
+        """Timeout for the asyncio session"""
+        return aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=read or self.read_timeout)
+
+    def get(self, url: str, read_timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        return self.session.get(url, timeout=self.timeout(read_timeout), **kwargs)
+
+    def post(self, url: str, read_timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        return self.session.post(url, timeout=self.timeout(read_timeout), **kwargs)
+
+    async def async_session(self) -> aiohttp.ClientSession:
+        """Shared aiohttp session, created on first use in the running loop"""
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_session.closed or self._async_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                             limit_per_host=self.per_host,
+                                             keepalive_timeout=self.keepalive)
+            self._async_session = aiohttp.ClientSession(connector=connector, timeout=self.async_timeout())
+            self._async_loop = loop
+        return self._async_session
+
+    async def aclose(self):
+        """Close both sessions"""
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+        self._async_session = None
+        self.session.close()
+
+    def close(self):
+        """Close the blocking session (use aclose inside an event loop)"""
+        self.session.close()
+
+
+_default_http: Optional[HttpClient] = None
+
+
+def default_http() -> HttpClient:
+    """Module wide client used by quick_chat"""
+    global _default_http
+    if _default_http is None:
+        _default_http = HttpClient()
+    return _default_http
+
+
+def decode_audio(data: bytes) -> Tuple[np.ndarray, int]:
+    """Decode WAV or MP3 bytes to mono float32 samples in [-1, 1] and their rate"""
+    if data[:4] == b"RIFF":
+        with wave.open(io.BytesIO(data)) as wav:
+            width = wav.getsampwidth()
+            channels = wav.getnchannels()
+            rate = wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+        if width == 1:
+            samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+        elif width == 2:
+            samples = np.frombuffer(frames, dtype='<i2').astype(np.float32) / 32768
+        elif width == 4:
+            samples = np.frombuffer(frames, dtype='<i4').astype(np.float32) / 2 ** 31
+        else:
+            raise ValueError(f"Unsupported WAV sample width: {width}")
+        if channels > 1:
+            samples = samples.reshape(-1, channels).mean(axis=1)
+        return samples, rate
+
+    try:
+        import miniaudio
+    except ImportError:
+        raise RuntimeError("Decoding MP3 needs the miniaudio package (pip install miniaudio)")
+    decoded = miniaudio.mp3_read_s16(data)
+    samples = np.frombuffer(decoded.samples, dtype=np.int16).astype(np.float32) / 32768
+    if decoded.nchannels > 1:
+        samples = samples.reshape(-1, decoded.nchannels).mean(axis=1)
+    return samples, decoded.sample_rate
+
+
+def resample(samples: np.ndarray, rate_in: int, rate_out: int) -> np.ndarray:
+    """Band-limited resampling in the frequency domain (drops everything above the new Nyquist)"""
+    if rate_in == rate_out or len(samples) == 0:
+        return samples
+    count = int(round(len(samples) * rate_out / rate_in))
+    spectrum = np.fft.rfft(samples)
+    bins = count // 2 + 1
+    if bins > len(spectrum):
+        spectrum = np.pad(spectrum, (0, bins - len(spectrum)))
+    return np.fft.irfft(spectrum[:bins], count).astype(np.float32) * (count / len(samples))
+
+
+def trim_silence(samples: np.ndarray, rate: int,
+                 threshold_db: float = -40.0, frame_ms: int = 10, pad_ms: int = 40) -> np.ndarray:
+    """Cut leading and trailing frames whose RMS is below threshold_db (dBFS)"""
+    frame = max(1, rate * frame_ms // 1000)
+    count = len(samples) // frame
+    if count == 0:
+        return samples
+    frames = samples[:count * frame].reshape(count, frame)
+    rms = np.sqrt(np.mean(frames * frames, axis=1) + 1e-12)
+    loud = np.flatnonzero(20 * np.log10(rms) > threshold_db)
+    if len(loud) == 0:
+        return samples[:0]
+    pad = rate * pad_ms // 1000
+    start = max(0, loud[0] * frame - pad)
+    end = min(len(samples), (loud[-1] + 1) * frame + pad)
+    return samples[start:end]
+
+
+def device_wav_header(data_size: int = 0xFFFFFFFF - 36, rate: int = DEVICE_SAMPLE_RATE) -> bytes:
+    """44 byte header for 8-bit mono PCM; the default size means 'until the stream ends'"""
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16,
+                       1, 1, rate, rate, 1, 8, b"data", data_size)
+
+
+def encode_device_pcm(samples: np.ndarray, normalize: bool = True) -> bytes:
+    """Quantize float samples to 8-bit unsigned PCM"""
+    if normalize and len(samples):
+        peak = float(np.max(np.abs(samples)))
+        if peak > 0:
+            samples = samples * (0.95 / peak)
+    return np.clip(np.rint(samples * 127.5 + 128), 0, 255).astype(np.uint8).tobytes()
+
+
+def encode_device_wav(samples: np.ndarray, rate: int = DEVICE_SAMPLE_RATE, normalize: bool = True) -> bytes:
+    """Quantize to 8-bit unsigned PCM in a 44 byte header WAV, the layout playWav reads"""
+    pcm = encode_device_pcm(samples, normalize)
+    return device_wav_header(len(pcm), rate) + pcm
+
+
+def encode_wav16(samples: np.ndarray, rate: int) -> bytes:
+    """Float samples to a 16-bit mono WAV buffer"""
+    pcm = np.clip(np.rint(samples * 32767), -32768, 32767).astype('<i2')
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b"RIFF", 36 + pcm.nbytes, b"WAVE", b"fmt ", 16,
+                       1, 1, rate, rate * 2, 2, 16, b"data", pcm.nbytes) + pcm.tobytes()
+
+
+def to_device_wav(data: bytes, trim: bool = True, normalize: bool = True) -> bytes:
+    """TTS output (MP3 or WAV) to the ESP32's 8-bit 16 kHz mono WAV, all in memory"""
+    with METRICS.span("transcode"):
+        samples, rate = decode_audio(data)
+        if trim:
+            samples = trim_silence(samples, rate)
+        samples = resample(samples, rate, DEVICE_SAMPLE_RATE)
+        return encode_device_wav(samples, DEVICE_SAMPLE_RATE, normalize)
+
+
+class AsteriskFilter:
+    """Remove *action* text from a token stream as it arrives"""
+
+    def __init__(self):
+        self.inside = False
+        self.pending = ""
+
+    def feed(self, chunk: str) -> str:
+        """Return the part of chunk that is outside asterisks"""
+        out = []
+        for ch in chunk:
+            if ch == '*':
+                self.inside = not self.inside
+                self.pending = ""
+            elif self.inside:
+                self.pending += ch
+            else:
+                out.append(ch)
+        return ''.join(out)
+
+    def flush(self) -> str:
+        """Give back text after an unmatched asterisk, like the regex filter does"""
+        rest = f"*{self.pending}" if self.inside else ""
+        self.inside = False
+        self.pending = ""
+        return rest
+
+
+class SentenceSplitter:
+    """Collect streamed text and hand out finished sentences"""
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """Add text and return every sentence completed by it"""
+        self.buffer += text
+        sentences = []
+        while True:
+            match = SENTENCE_END.search(self.buffer)
+            if not match:
+                break
+            sentence = re.sub(r'\s+', ' ', self.buffer[:match.end(1)]).strip()
+            self.buffer = self.buffer[match.end():]
+            if sentence:
+                sentences.append(sentence)
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        """Return whatever is left once the stream has ended"""
+        sentence = re.sub(r'\s+', ' ', self.buffer).strip()
+        self.buffer = ""
+        return sentence or None
+
+    @classmethod
+    def split(cls, text: str) -> List[str]:
+        """Every sentence of a finished text"""
+        splitter = cls()
+        sentences = splitter.feed(text + " ")
+        rest = splitter.flush()
+        if rest:
+            sentences.append(rest)
+        return sentences
+
+
+class SnippetScanner:
+    """Incremental scan of a results page for the first usable answer
+
+    Text directly inside a snippet element (class BNeawe*, hgKElc or st)
+    closed by </span> is the answer, taken in page order, and feed()
+    returns it as soon as it is complete so the caller can stop
+    downloading. Each chunk is scanned up to its last </span>; the rest
+    waits for the next one. Pages without a snippet fall back to the first
+    plain <div>text</div> of a sensible length once the page has ended.
+    """
+
+    SNIPPET = re.compile(r'class="(?:BNeawe[^"]*|hgKElc|st)"[^>]*>([^<]+)</span>')
+    DIV = re.compile(r'<div[^>]*>([^<]+)</div>')
+
+    def __init__(self):
+        self.answer: Optional[str] = None
+        self.chars = 0
+        self.buffer = ""
+        self.chunks: List[str] = []
+
+    @staticmethod
+    def _usable(text: str, low: int, high: int, skip: List[str]) -> Optional[str]:
+        text = html.unescape(text).strip()
+        lowered = text.lower()
+        if low < len(text) < high and not any(word in lowered for word in skip):
+            return text
+        return None
+
+    def feed(self, data: str) -> Optional[str]:
+        """Scan the next piece of the page; returns the answer once found"""
+        if self.answer is not None:
+            return self.answer
+        self.chars += len(data)
+        self.chunks.append(data)
+        self.buffer += data
+
+        end = self.buffer.rfind("</span>")
+        if end < 0:
+            return None
+        for match in self.SNIPPET.finditer(self.buffer, 0, end + 7):
+            self.answer = self._usable(match.group(1), 20, sys.maxsize, SNIPPET_SKIP)
+            if self.answer is not None:
+                return self.answer
+        self.buffer = self.buffer[end + 7:]
+        return None
+
+    def result(self) -> Tuple[Optional[str], bool]:
+        """(answer, is_snippet) once the page has ended"""
+        if self.answer is not None:
+            return self.answer, True
+        for match in self.DIV.finditer("".join(self.chunks)):
+            fallback = self._usable(match.group(1), 30, 200, SNIPPET_SKIP + ['videos'])
+            if fallback is not None:
+                return fallback, False
+        return None, False
+
+
+class SearchBackend:
+    """Somewhere search_google can look an answer up
+
+    search() returns one sentence or None when there is no confident
+    answer, and raises when the backend itself failed. Answers from
+    cacheable backends go through the shared SearchCache.
+    """
+
+    name = "backend"
+    cacheable = True
+
+    def search(self, query: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def search_async(self, query: str) -> Optional[str]:
+        return self.search(query)
+
+    async def aclose(self):
+        pass
+
+
+class GoogleSearch(SearchBackend):
+    """First snippet of a Google results page, read only as far as needed"""
+
+    name = "google"
+
+    def __init__(self, http: Optional[HttpClient] = None, url: str = SEARCH_URL):
+        self.http = http or default_http()
+        self.url = url
+
+    @staticmethod
+    def answer(scanner: SnippetScanner) -> Optional[str]:
+        answer, is_snippet = scanner.result()
+        METRICS.count("search_chars", scanner.chars)
+        if answer is None:
+            log.info("🔍 No clear answer found in search results")
+        elif is_snippet:
+            log.info(f"🔍 Google says: {answer}")
+        else:
+            log.info(f"🔍 Google found: {answer}")
+        return answer
+
+    def search(self, query: str) -> Optional[str]:
+        url = f"{self.url}?q={quote_plus(query)}"
+        with self.http.get(url, headers=SEARCH_HEADERS, read_timeout=10, stream=True) as response:
+            if response.status_code != 200:
+                raise ConnectionError(f"Google search failed: {response.status_code}")
+            scanner = SnippetScanner()
+            decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+            for chunk in response.iter_content(chunk_size=8192):
+                if scanner.feed(decoder.decode(chunk)):
+                    break
+            else:
+                scanner.feed(decoder.decode(b"", final=True))
+        return self.answer(scanner)
+
+    async def search_async(self, query: str) -> Optional[str]:
+        url = f"{self.url}?q={quote_plus(query)}"
+        session = await self.http.async_session()
+        async with session.get(url, headers=SEARCH_HEADERS, timeout=self.http.async_timeout(10)) as response:
+            if response.status != 200:
+                raise ConnectionError(f"Google search failed: {response.status}")
+            scanner = SnippetScanner()
+            decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+            async for chunk in response.content.iter_chunked(8192):
+                if scanner.feed(decoder.decode(chunk)):
+                    break
+            else:
+                scanner.feed(decoder.decode(b"", final=True))
+        return self.answer(scanner)
+
+
+def index_terms(text: str) -> List[str]:
+    """Lowercase word tokens without stopwords or plural s, for LocalIndex"""
+    return [word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+            for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOPWORDS]
+
+
+class LocalIndex(SearchBackend):
+    """BM25 index over a folder of .txt/.md notes, stored on disk and memory-mapped
+
+    build() only reads files whose size or mtime changed; the postings of
+    unchanged files are carried over from the existing index. Passages are
+    paragraphs (with their markdown heading's words), and the answer is the
+    sentence of the best passage that carries the most query weight. A hit
+    needs min_score and must cover min_coverage of the query's idf weight,
+    otherwise search() returns None and the next backend gets the question.
+    """
+
+    name = "local"
+    cacheable = False
+    EXTENSIONS = (".txt", ".md", ".markdown")
+    VERSION = 1
+
+    def __init__(self,
+                 directory: str = "knowledge_index",
+                 source: Optional[str] = None,
+                 k1: float = 1.2,
+                 b: float = 0.75,
+                 min_score: float = 1.0,
+                 min_coverage: float = 0.6,
+                 max_words: int = 120):
+        self.directory = directory
+        self.k1 = k1
+        self.b = b
+        self.min_score = min_score
+        self.min_coverage = min_coverage
+        self.max_words = max_words
+        self._maps: List[mmap.mmap] = []
+        self._views: List[memoryview] = []
+        self.load()
+        if source:
+            self.build(source)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _map(self, name: str, typecode: Optional[str] = None):
+        """Memory-map one index file (empty files come back as empty views)"""
+        with open(self._path(name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"").cast(typecode) if typecode else b""
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        if typecode is None:
+            return mapped
+        view = memoryview(mapped).cast(typecode)
+        self._views.append(view)
+        return view
+
+    def load(self):
+        """Open the index on disk, if there is one"""
+        self.close()
+        self.files: Dict[str, List[int]] = {}
+        self.terms: Dict[str, List[int]] = {}
+        self.count = 0
+        self.avgdl = 0.0
+        try:
+            with open(self._path("index.json"), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        if meta.get("version") != self.VERSION:
+            log.warning("📚 Local index has an old format, rebuild it")
+            return
+        self.files = meta["files"]
+        self.terms = meta["terms"]
+        self.count = meta["count"]
+        self.avgdl = meta["avgdl"]
+        self.postings = self._map("postings.bin", 'I')
+        self.lengths = self._map("lengths.bin", 'I')
+        self.offsets = self._map("offsets.bin", 'Q')
+        self.texts = self._map("passages.bin")
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._views, self._maps = [], []
+
+    def passage(self, pid: int) -> str:
+        return bytes(self.texts[self.offsets[pid]:self.offsets[pid + 1]]).decode('utf-8')
+
+    def _passages(self, text: str) -> List[Tuple[str, Counter]]:
+        """Split a note into (passage text, term counts)"""
+        passages = []
+        heading: List[str] = []
+        for block in re.split(r'\n\s*\n', text):
+            lines = [line.strip() for line in block.strip().splitlines() if line.strip()]
+            if lines and lines[0].startswith('#'):
+                heading = index_terms(lines.pop(0).lstrip('#'))
+            body = re.sub(r'\s+', ' ', " ".join(re.sub(r'^([-*+>]|\d+\.)\s+', '', line) for line in lines)).strip()
+            if not body:
+                continue
+            sentences = re.split(r'(?<=[.!?])\s+', body)
+            current: List[str] = []
+            for sentence in sentences + [None]:
+                if sentence is None or (current and len(" ".join(current + [sentence]).split()) > self.max_words):
+                    passage = " ".join(current)
+                    passages.append((passage, Counter(heading + index_terms(passage))))
+                    current = []
+                if sentence is not None:
+                    current.append(sentence)
+        return passages
+
+    def build(self, source: str) -> Dict[str, int]:
+        """Bring the index up to date with the notes under source"""
+        found = {}
+        for root, _, names in os.walk(source):
+            for name in names:
+                if name.lower().endswith(self.EXTENSIONS):
+                    path = os.path.join(root, name)
+                    info = os.stat(path)
+                    found[os.path.relpath(path, source)] = [info.st_mtime_ns, info.st_size]
+
+        unchanged = {rel for rel, signature in found.items() if self.files.get(rel, [None, None])[:2] == signature}
+        changes = {"unchanged": len(unchanged),
+                   "indexed": len(found) - len(unchanged),
+                   "removed": len(set(self.files) - set(found))}
+        if changes["indexed"] == 0 and changes["removed"] == 0:
+            return changes
+
+        kept = {pid for rel in unchanged for pid in range(self.files[rel][2], self.files[rel][2] + self.files[rel][3])}
+        carried: Dict[int, Counter] = {pid: Counter() for pid in kept}
+        if kept:
+            for term, (offset, df) in self.terms.items():
+                for i in range(offset * 2, (offset + df) * 2, 2):
+                    if self.postings[i] in carried:
+                        carried[self.postings[i]][term] = self.postings[i + 1]
+
+        files, passages = {}, []
+        for rel in sorted(found):
+            if rel in unchanged:
+                first, count = self.files[rel][2:]
+                part = [(self.passage(pid), carried[pid]) for pid in range(first, first + count)]
+            else:
+                with open(os.path.join(source, rel), 'r', encoding='utf-8', errors='replace') as f:
+                    part = self._passages(f.read())
+            files[rel] = found[rel] + [len(passages), len(part)]
+            passages.extend(part)
+
+        self._write(files, passages)
+        self.load()
+        log.info(f"📚 Indexed {changes['indexed']} notes ({changes['unchanged']} unchanged, "
+                 f"{changes['removed']} removed), {self.count} passages")
+        return changes
+
+    def _write(self, files: Dict[str, List[int]], passages: List[Tuple[str, Counter]]):
+        """Write the index files next to each other, index.json last"""
+        postings: Dict[str, List[int]] = {}
+        for pid, (_, counts) in enumerate(passages):
+            for term, tf in counts.items():
+                postings.setdefault(term, []).extend((pid, tf))
+        terms, flat = {}, array('I')
+        for term in sorted(postings):
+            terms[term] = [len(flat) // 2, len(postings[term]) // 2]
+            flat.extend(postings[term])
+        texts = [text.encode('utf-8') for text, _ in passages]
+        offsets = array('Q', [0])
+        for text in texts:
+            offsets.append(offsets[-1] + len(text))
+        lengths = array('I', (sum(counts.values()) for _, counts in passages))
+
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        blobs = {"postings.bin": flat.tobytes(), "lengths.bin": lengths.tobytes(),
+                 "offsets.bin": offsets.tobytes(), "passages.bin": b"".join(texts),
+                 "index.json": json.dumps({"version": self.VERSION, "files": files, "terms": terms,
+                                           "count": len(passages),
+                                           "avgdl": sum(lengths) / len(passages) if passages else 0.0},
+                                          ensure_ascii=False).encode('utf-8')}
+        for name, blob in blobs.items():
+            tmp_path = self._path(name + ".tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp_path, self._path(name))
+
+    def _idf(self, df: int) -> float:
+        return math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+
+    def query(self, query: str, limit: int = 3) -> List[Tuple[float, float, int]]:
+        """Best passages as (score, share of the query's idf weight covered, passage id)"""
+        terms = set(index_terms(query))
+        if not terms or not self.count:
+            return []
+        scores: Dict[int, float] = {}
+        covered: Dict[int, float] = {}
+        total = 0.0
+        for term in terms:
+            offset, df = self.terms.get(term, (0, 0))
+            idf = self._idf(df)
+            total += idf
+            for i in range(offset * 2, (offset + df) * 2, 2):
+                pid, tf = self.postings[i], self.postings[i + 1]
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[pid] / self.avgdl)
+                scores[pid] = scores.get(pid, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+                covered[pid] = covered.get(pid, 0.0) + idf
+        best = sorted(scores, key=scores.get, reverse=True)[:limit]
+        return [(scores[pid], covered[pid] / total, pid) for pid in best]
+
+    def snippet(self, pid: int, query: str) -> str:
+        """The sentence of a passage carrying the most query weight"""
+        weights = {term: self._idf(self.terms[term][1]) for term in set(index_terms(query)) if term in self.terms}
+        sentences = re.split(r'(?<=[.!?])\s+', self.passage(pid))
+        return max(sentences, key=lambda sentence: sum(weights.get(term, 0.0) for term in set(index_terms(sentence))))
+
+    def search(self, query: str) -> Optional[str]:
+        results = self.query(query, 1)
+        if not results:
+            return None
+        score, coverage, pid = results[0]
+        if score < self.min_score or coverage < self.min_coverage:
+            log.debug(f"📚 No confident local hit (score {score:.2f}, coverage {coverage:.0%})")
+            return None
+        answer = self.snippet(pid, query)
+        log.info(f"📚 Notes say: {answer}")
+        return answer
+
+
+_default_index: Optional[LocalIndex] = None
+
+
+def default_search_index(directory: str = "knowledge_index") -> Optional[LocalIndex]:
+    """The local notes index, if one has been built (python ai.py index <notes>)"""
+    global _default_index
+    if _default_index is None and os.path.exists(os.path.join(directory, "index.json")):
+        _default_index = LocalIndex(directory)
+    return _default_index
+
+
+class ServiceOverloaded(Exception):
+    """Raised when too many requests are already waiting for LM Studio"""
+
+
+class RequestGate:
+    """Concurrency limit with a bounded wait queue in front of LM Studio
+
+    At most max_concurrent completions run at once and at most max_queued
+    wait for a slot; beyond that callers get ServiceOverloaded right away
+    instead of piling up behind a busy backend.
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_queued: int = 32):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    async def __aenter__(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queued:
+            self.rejected += 1
+            METRICS.count("overloaded")
+            raise ServiceOverloaded(f"{self.waiting} requests already queued for LM Studio")
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self.active -= 1
+        self.semaphore.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": self.active, "waiting": self.waiting, "rejected": self.rejected,
+                "max_concurrent": self.max_concurrent, "max_queued": self.max_queued}
+
+
+class DeviceClient:
+    """Sends reply audio to the ESP32 /upload endpoint
+
+    By default the whole reply is sent as one body with a Content-Length,
+    because handleUpload in serverer.ino only reads server.arg("plain")
+    and answers 400 to a chunked POST. With chunked=True (for firmware
+    that reads the request stream) audio is cut into chunk_size pieces
+    and sent as it is produced in one keep-alive POST; at most max_pending
+    chunks wait in memory, so a slow link slows the producer down instead
+    of piling up audio. If the Wi-Fi drops mid-upload the request is
+    retried: everything already produced is re-sent from a local buffer,
+    without re-running the LLM or TTS. If the audio stream itself fails,
+    or yields nothing, nothing is uploaded (a chunked POST is aborted
+    before its final chunk) and the upload counts as failed.
+    """
+
+    def __init__(self,
+                 base_url: str = "http://testudo.local",
+                 chunk_size: int = 4096,
+                 max_pending: int = 8,
+                 retries: int = 3,
+                 backoff: float = 0.5,
+                 chunked: bool = False,
+                 http: Optional[HttpClient] = None):
+        self.base_url = base_url.rstrip("/")
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.retries = retries
+        self.backoff = backoff
+        self.chunked = chunked
+        self.http = http or HttpClient(per_host=2, read_timeout=10)
+        self.stats = {"uploads": 0, "failures": 0, "retries": 0, "bytes": 0,
+                      "last_seconds": 0.0, "last_bytes_per_second": 0.0}
+
+    async def upload(self, audio: Union[bytes, AsyncIterator[bytes]]) -> bool:
+        """Send a whole buffer or an async stream of audio to /upload"""
+        if isinstance(audio, (bytes, bytearray)):
+            data = bytes(audio)
+
+            async def once():
+                yield data
+            audio = once()
+        return await self.upload_stream(audio)
+
+    async def upload_stream(self, audio: AsyncIterator[bytes]) -> bool:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_pending)
+        error: Optional[Exception] = None
+
+        async def produce():
+            nonlocal error
+            pending = b""
+            try:
+                async for data in audio:
+                    pending += data
+                    while len(pending) >= self.chunk_size:
+                        await queue.put(pending[:self.chunk_size])
+                        pending = pending[self.chunk_size:]
+                if pending:
+                    await queue.put(pending)
+            except Exception as e:
+                error = e
+            finally:
+                await queue.put(None)
+
+        sent: List[bytes] = []
+        finished = False
+
+        async def body():
+            nonlocal finished, error
+            for chunk in list(sent):
+                yield chunk
+            while not finished:
+                chunk = await queue.get()
+                if chunk is None:
+                    finished = True
+                    break
+                sent.append(chunk)
+                yield chunk
+            if error is None and not sent:
+                error = ValueError("the audio stream was empty")
+            if error is not None:
+                raise error
+
+        producer = asyncio.create_task(produce())
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    if self.chunked:
+                        data = body()
+                    else:
+                        data = b"".join([chunk async for chunk in body()])
+                    session = await self.http.async_session()
+                    async with session.post(f"{self.base_url}/upload", data=data,
+                                            headers={"Content-Type": "audio/wav"}) as response:
+                        await response.read()
+                        if response.status == 200:
+                            return self._uploaded(sum(len(c) for c in sent), time.perf_counter() - start)
+                        log.error(f"❌ Device upload failed: {response.status}")
+                        if response.status < 500:
+                            break
+                except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                    if error is not None:
+                        break
+                    log.warning(f"📶 Device link dropped ({e!r}), retry {attempt + 1}/{self.retries}")
+                except Exception as e:
+                    if e is not error:
+                        raise
+                    break
+                if attempt < self.retries:
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+            if error is not None:
+                log.error(f"❌ No audio for the device: {error!r}")
+            self.stats["failures"] += 1
+            return False
+        finally:
+            producer.cancel()
+
+    def _uploaded(self, size: int, seconds: float) -> bool:
+        self.stats["uploads"] += 1
+        self.stats["bytes"] += size
+        self.stats["last_seconds"] = seconds
+        self.stats["last_bytes_per_second"] = size / seconds if seconds else 0.0
+        log.info(f"📤 Sent {size} bytes to device in {seconds:.2f}s")
+        return True
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+class EndpointsDown(ConnectionError):
+    """Raised when every LLM endpoint has failed or has its circuit breaker open"""
+
+
+class LLMEndpoint:
+    """One OpenAI-compatible server in an LLMPool and its breaker state"""
+
+    def __init__(self, url: str):
+        self.url = url.strip().rstrip("/")
+        self.outstanding = 0
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self.latency = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"url": self.url, "state": "closed" if self.opened_at is None else "open",
+                "outstanding": self.outstanding, "requests": self.requests, "errors": self.errors,
+                "latency_ms": round(self.latency * 1000, 1)}
+
+
+class LLMPool:
+    """Spreads completions over several LM Studio / OpenAI-compatible servers
+
+    Each request goes to the endpoint with the fewest requests in flight
+    (ties: lowest average latency). failure_threshold errors in a row open
+    an endpoint's circuit breaker: it gets no traffic for cooldown seconds,
+    then one trial request decides whether it closes again. A request that
+    fails is retried on the next endpoint. With hedge_after set, a request
+    still running after that many seconds is also sent to a second endpoint
+    (a backup that fails is replaced by the next one) and the first answer
+    wins. While an event loop is running, every endpoint's /v1/models is
+    probed every probe_interval seconds so a dead box is noticed (and a
+    recovered one let back in) without user traffic.
+    Streams are routed and counted but not retried or hedged.
+    """
+
+    def __init__(self,
+                 urls: Union[str, List[str]] = LM_STUDIO_URL,
+                 http: Optional[HttpClient] = None,
+                 timeout: float = 30.0,
+                 failure_threshold: int = 3,
+                 cooldown: float = 10.0,
+                 hedge_after: Optional[float] = None,
+                 probe_interval: float = 15.0):
+        if isinstance(urls, str):
+            urls = urls.split(",")
+        self.endpoints = [LLMEndpoint(url) for url in urls if url.strip()]
+        if not self.endpoints:
+            raise ValueError("LLMPool needs at least one endpoint")
+        self.http = http or default_http()
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedge_after = hedge_after
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self._prober: Optional[asyncio.Task] = None
+        self._hedge_pool: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def url(self) -> str:
+        """The first endpoint, used to key the model listing"""
+        return self.endpoints[0].url
+
+    def _available(self, endpoint: LLMEndpoint, now: float) -> bool:
+        if endpoint.opened_at is None:
+            return True
+        return not endpoint.trial and now - endpoint.opened_at >= self.cooldown
+
+    def pick(self, exclude: Iterable[LLMEndpoint] = ()) -> LLMEndpoint:
+        """Reserve the least busy endpoint whose breaker lets traffic through"""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [e for e in self.endpoints if e not in exclude and self._available(e, now)]
+            if not candidates:
+                raise EndpointsDown(f"no LLM endpoint available out of {len(self.endpoints)}")
+            endpoint = min(candidates, key=lambda e: (e.outstanding, e.latency))
+            if endpoint.opened_at is not None:
+                endpoint.trial = True
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: LLMEndpoint, ok: Optional[bool], seconds: float = 0.0):
+        """Return a reservation; ok=None (cancelled) counts neither way"""
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.trial = False
+            if ok:
+                endpoint.latency = seconds if not endpoint.latency else 0.8 * endpoint.latency + 0.2 * seconds
+                self._succeeded(endpoint)
+            elif ok is not None:
+                endpoint.errors += 1
+                self._failed(endpoint)
+
+    def _succeeded(self, endpoint: LLMEndpoint):
+        if endpoint.opened_at is not None:
+            log.info(f"🔌 LLM endpoint {endpoint.url} is back")
+        endpoint.failures = 0
+        endpoint.opened_at = None
+
+    def _failed(self, endpoint: LLMEndpoint):
+        endpoint.failures += 1
+        if endpoint.opened_at is not None or endpoint.failures >= self.failure_threshold:
+            if endpoint.opened_at is None:
+                log.warning(f"⚡ LLM endpoint {endpoint.url} failed {endpoint.failures} times, "
+                            f"pausing it for {self.cooldown:.0f}s")
+                METRICS.count("llm_breaker_opened")
+            endpoint.opened_at = time.monotonic()
+
+    def _check(self, endpoint: LLMEndpoint, status: int):
+        """Server-side errors count against the endpoint; 4xx are the request's fault"""
+        if status >= 500 or status == 429:
+            raise ConnectionError(f"{endpoint.url} answered {status}")
+
+    def post_json(self, path: str, payload: Dict[str, Any]) -> Tuple[int, Any]:
+        """Blocking POST routed over the pool; (status, JSON body)"""
+        tried: List[LLMEndpoint] = []
+        while True:
+            endpoint = self.pick(tried)
+            tried.append(endpoint)
+            try:
+                return self._hedged(endpoint, path, payload, tried)
+            except (requests.RequestException, ConnectionError, ValueError) as e:
+                log.warning(f"⚠️ LLM endpoint {endpoint.url} failed: {e!r}")
+
+    def _send(self, endpoint: LLMEndpoint, path: str, payload: Dict[str, Any]) -> Tuple[int, Any]:
+        start = time.perf_counter()
+        try:
+            response = self.http.post(endpoint.url + path, json=payload, read_timeout=self.timeout)
+            self._check(endpoint, response.status_code)
+            result = response.status_code, response.json()
+        except BaseException:
+            self.release(endpoint, False)
+            raise
+        self.release(endpoint, True, time.perf_counter() - start)
+        return result
+
+    def _hedged(self, endpoint: LLMEndpoint, path: str, payload: Dict[str, Any],
+                tried: List[LLMEndpoint]) -> Tuple[int, Any]:
+        if self.hedge_after is None or len(self.endpoints) < 2:
+            return self._send(endpoint, path, payload)
+        if self._hedge_pool is None:
+            self._hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="testudo-hedge")
+        first = self._hedge_pool.submit(self._send, endpoint, path, payload)
+        done, _ = wait_futures([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+        pending = {first}
+        while True:
+            backup = self._backup(pending, tried)
+            if backup is not None:
+                pending.add(self._hedge_pool.submit(self._send, backup, path, payload))
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        METRICS.count("llm_hedge_wins")
+                    return future.result()
+            if not pending:
+                return done.pop().result()
+            for future in done:
+                log.warning(f"⚠️ Hedged LLM request failed: {future.exception()!r}")
+
+    def _backup(self, pending: set, tried: List[LLMEndpoint]) -> Optional[LLMEndpoint]:
+        """Another endpoint to hedge on while fewer than two requests are in flight"""
+        if len(pending) >= 2:
+            return None
+        try:
+            backup = self.pick(tried)
+        except EndpointsDown:
+            return None
+        tried.append(backup)
+        METRICS.count("llm_hedged")
+        return backup
+
+    async def post_json_async(self, path: str, payload: Dict[str, Any]) -> Tuple[int, Any]:
+        """post_json on the asyncio session"""
+        self._start_probes()
+        tried: List[LLMEndpoint] = []
+        while True:
+            endpoint = self.pick(tried)
+            tried.append(endpoint)
+            try:
+                return await self._hedged_async(endpoint, path, payload, tried)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError, ValueError) as e:
+                log.warning(f"⚠️ LLM endpoint {endpoint.url} failed: {e!r}")
+
+    async def _send_async(self, endpoint: LLMEndpoint, path: str, payload: Dict[str, Any]) -> Tuple[int, Any]:
+        start = time.perf_counter()
+        try:
+            session = await self.http.async_session()
+            async with session.post(endpoint.url + path, json=payload,
+                                    timeout=self.http.async_timeout(self.timeout)) as response:
+                self._check(endpoint, response.status)
+                result = response.status, await response.json(content_type=None)
+        except asyncio.CancelledError:
+            self.release(endpoint, None)
+            raise
+        except BaseException:
+            self.release(endpoint, False)
+            raise
+        self.release(endpoint, True, time.perf_counter() - start)
+        return result
+
+    async def _hedged_async(self, endpoint: LLMEndpoint, path: str, payload: Dict[str, Any],
+                            tried: List[LLMEndpoint]) -> Tuple[int, Any]:
+        if self.hedge_after is None or len(self.endpoints) < 2:
+            return await self._send_async(endpoint, path, payload)
+        first = asyncio.ensure_future(self._send_async(endpoint, path, payload))
+        done, _ = await asyncio.wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+        pending = {first}
+        try:
+            while True:
+                backup = self._backup(pending, tried)
+                if backup is not None:
+                    pending.add(asyncio.ensure_future(self._send_async(backup, path, payload)))
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            METRICS.count("llm_hedge_wins")
+                        return task.result()
+                if not pending:
+                    return done.pop().result()
+                for task in done:
+                    log.warning(f"⚠️ Hedged LLM request failed: {task.exception()!r}")
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @asynccontextmanager
+    async def stream(self, path: str, payload: Dict[str, Any]) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Open a streamed POST on the least busy endpoint"""
+        self._start_probes()
+        endpoint = self.pick()
+        start = time.perf_counter()
+        ok: Optional[bool] = False
+        try:
+            session = await self.http.async_session()
+            async with session.post(endpoint.url + path, json=payload,
+                                    timeout=self.http.async_timeout(self.timeout)) as response:
+                self._check(endpoint, response.status)
+                yield response
+            ok = True
+        except (asyncio.CancelledError, GeneratorExit):
+            ok = None
+            raise
+        finally:
+            self.release(endpoint, ok, time.perf_counter() - start)
+
+    async def probe(self, endpoint: LLMEndpoint) -> bool:
+        """The /v1/models check against one endpoint, feeding its breaker"""
+        try:
+            session = await self.http.async_session()
+            async with session.get(f"{endpoint.url}/v1/models", timeout=self.http.async_timeout(5)) as response:
+                healthy = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            healthy = False
+        with self.lock:
+            if healthy:
+                self._succeeded(endpoint)
+            else:
+                self._failed(endpoint)
+        return healthy
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            await asyncio.gather(*(self.probe(endpoint) for endpoint in self.endpoints))
+
+    def _start_probes(self):
+        """Run health probes in the current event loop (restarted if the loop changed)"""
+        if not self.probe_interval or (self._prober is not None and not self._prober.done()):
+            return
+        self._prober = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [endpoint.stats() for endpoint in self.endpoints]
+
+    async def aclose(self):
+        """Stop the health probes (the HTTP client belongs to the caller)"""
+        if self._prober is not None:
+            self._prober.cancel()
+            self._prober = None
+        if self._hedge_pool is not None:
+            self._hedge_pool.shutdown(wait=False, cancel_futures=True)
+            self._hedge_pool = None
+
+
+_llm_pools: Dict[str, LLMPool] = {}
+
+
+def default_llm_pool(lm_studio_url: Union[str, List[str]] = LM_STUDIO_URL) -> LLMPool:
+    """Module wide pool per endpoint list, used by quick_chat"""
+    key = lm_studio_url if isinstance(lm_studio_url, str) else ",".join(lm_studio_url)
+    if key not in _llm_pools:
+        _llm_pools[key] = LLMPool(lm_studio_url)
+    return _llm_pools[key]
+
+
 class TestudoAI:
     def __init__(self, 
-                 lm_studio_url: str = "http://localhost:1234",
+                 lm_studio_url: Union[str, List[str]] = LM_STUDIO_URL,
                  model_name: str = "emotion-llama",
                  voice: str = "en-US-JennyNeural",
-                 user_data_file: str = "user_data.json"):
-        self.lm_studio_url = lm_studio_url
+                 user_data_file: str = "user_data.json",
+                 user_id: str = "default",
+                 user_store: Optional[UserStore] = None,
+                 http: Optional[HttpClient] = None,
+                 search_cache: Optional[SearchCache] = None,
+                 search_policy: str = "sequential",
+                 response_cache: Optional[ResponseCache] = None,
+                 cache_replies: bool = True,
+                 memory: Optional[ConversationMemory] = None,
+                 audio_cache: Optional[AudioCache] = None,
+                 llm_gate: Optional[RequestGate] = None,
+                 search_url: str = SEARCH_URL,
+                 model_cache: Optional[ModelCache] = None,
+                 search_backends: Optional[List[SearchBackend]] = None,
+                 web_search: bool = True,
+                 prompt_layout: str = "classic",
+                 prompt_hints: bool = False,
+                 llm_pool: Optional[LLMPool] = None,
+                 hedge_after: Optional[float] = None,
+                 intent_router: Optional[IntentRouter] = None):
+        if search_policy not in SEARCH_POLICIES:
+            raise ValueError(f"search_policy must be one of {SEARCH_POLICIES}")
+        if prompt_layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"prompt_layout must be one of {PROMPT_LAYOUTS}")
+        self.http = http or HttpClient()
+        self._owns_http = http is None
+        self.llm = llm_pool or LLMPool(lm_studio_url, self.http, hedge_after=hedge_after)
+        self._owns_llm = llm_pool is None
+        self.lm_studio_url = self.llm.url
+        self.llm_gate = llm_gate
+        self.search_cache = search_cache if search_cache is not None else default_search_cache()
         self.model_name = model_name
         self.voice = voice
-        self.conversation_history = []
+        self.memory = memory or ConversationMemory(block=4 if prompt_layout == "stable" else 1)
+        self.prompt_layout = prompt_layout
+        self.prompt_hints = prompt_hints
+        self._last_messages: List[Dict[str, str]] = []
+        self.audio_cache = audio_cache or AudioCache()
+        self.last_audio: Optional[str] = None
         self.user_data_file = user_data_file
+        self.user_id = user_id
+        self.user_store = user_store or open_user_store(os.path.splitext(user_data_file)[0] + ".db")
         self.user_data = self.load_user_data()
-        self.system_prompt = "You are Testudo, an ai enabled pet like companion. Designed as an turtle. Reply in 1–2 short natural sentences. Avoid emoticons or roleplay stage directions. Don't call people 'friend', 'creator', or other names unless you know their actual name from the conversation. Never use asterisks for actions or movements."
+        self.system_prompt = SYSTEM_PROMPT
+        self.intents = intent_router or IntentRouter()
+        self.search_policy = search_policy
+        self.search_url = search_url
+        if search_backends is None:
+            search_backends = [index for index in (default_search_index(),) if index is not None]
+        self.search_backends = list(search_backends)
+        if web_search:
+            self.search_backends.append(GoogleSearch(self.http, search_url))
+        self.model_cache = model_cache if model_cache is not None else default_model_cache()
+        self._model_refresh: Optional[asyncio.Task] = None
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
+        self.cache_replies = cache_replies
+        self.last_route: Optional[str] = None
+        self.route_counts = {"local": 0, "llm": 0, "search": 0}
+        self._search_pool: Optional[ThreadPoolExecutor] = None
     
     def load_user_data(self) -> Dict[str, Any]:
-        """Load user data from JSON file"""
+        """Load this user's profile from the store (importing an old JSON file once)"""
         try:
-            if os.path.exists(self.user_data_file):
-                with open(self.user_data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    print(f"Loaded user data: {list(data.keys())}")
-                    return data
+            data = self.user_store.load(self.user_id)
+            # The old JSON file held the single pre-store profile; it belongs to "default" only
+            if not data and self.user_id == "default" and os.path.exists(self.user_data_file):
+                data = self.user_store.import_json(self.user_data_file, self.user_id)
+                log.info(f"Imported {self.user_data_file} into {self.user_store.path}")
+            if data:
+                log.info(f"Loaded user data: {list(data.keys())}")
             else:
-                print("No user data file found, creating new one")
-                return {}
+                log.info("No user data found, starting a new profile")
+            return data
         except Exception as e:
-            print(f" Error loading user data: {e}")
+            log.error(f"Error loading user data: {e}")
             return {}
     
     def save_user_data(self):
-        """Save user data to JSON file"""
-        try:
-            with open(self.user_data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.user_data, f, indent=2, ensure_ascii=False)
-            print(f"User data saved to {self.user_data_file}")
-        except Exception as e:
-            print(f" Error saving user data: {e}")
+        """Queue the whole profile for the background writer"""
+        self.user_store.update(self.user_id, self.user_data)
     
     def extract_personal_info(self, message: str) -> Dict[str, Any]:
         """Extract personal information from user message"""
-        extracted = {}
-        message_lower = message.lower().strip()
-        
-
-        name_patterns = [
-            r"my name is ([a-zA-Z\s]+)",
-            r"i'm ([a-zA-Z\s]+)",
-            r"i am ([a-zA-Z\s]+)",
-            r"call me ([a-zA-Z\s]+)",
-            r"i'm called ([a-zA-Z\s]+)"
-        ]
-        
-        for pattern in name_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                name = match.group(1).strip().title()
-
-                common_words = ['happy', 'sad', 'tired', 'good', 'fine', 'okay', 'great', 'studying', 'working', 'here', 'back', 'done']
-                if name.lower() not in common_words and len(name) > 1:
-                    extracted['name'] = name
-                    break
-        
- 
-        age_patterns = [
-            r"i am (\d+) years old",
-            r"i'm (\d+) years old",
-            r"i am (\d+)",
-            r"i'm (\d+)",
-            r"(\d+) years old"
-        ]
-        
-        for pattern in age_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                age = int(match.group(1))
-                if 1 <= age <= 120: 
-                    extracted['age'] = age
-                    break
-        
-        location_patterns = [
-            r"i live in ([a-zA-Z\s]+)",
-            r"i'm from ([a-zA-Z\s]+)",
-            r"i am from ([a-zA-Z\s]+)",
-            r"i'm in ([a-zA-Z\s]+)",
-            r"i am in ([a-zA-Z\s]+)"
-        ]
-        
-        for pattern in location_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                location = match.group(1).strip().title()
-                if len(location) > 1:
-                    extracted['location'] = location
-                    break
-        
-
-        job_patterns = [
-            r"i work as a ([a-zA-Z\s]+)",
-            r"i work as an ([a-zA-Z\s]+)",
-            r"i am a ([a-zA-Z\s]+)",
-            r"i'm a ([a-zA-Z\s]+)",
-            r"my job is ([a-zA-Z\s]+)"
-        ]
-        
-        for pattern in job_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                job = match.group(1).strip().title()
-
-                job_words = ['student', 'teacher', 'doctor', 'engineer', 'programmer', 'developer', 'designer', 'writer', 'artist', 'lawyer', 'nurse', 'manager']
-                if any(word in job.lower() for word in job_words) or len(job.split()) <= 3:
-                    extracted['occupation'] = job
-                    break
-        
-        return extracted
+        return MATCHER.personal_info(message)
+    
+    def extract_batch(self, messages: Iterable[str]) -> List[Dict[str, Any]]:
+        """Run the matcher over many messages, e.g. a saved transcript"""
+        return MATCHER.extract_batch(messages)
     
     def update_user_data(self, new_data: Dict[str, Any]):
         """Update user data with new information"""
-        updated = False
+        changes = {}
         for key, value in new_data.items():
             if key not in self.user_data or self.user_data[key] != value:
                 self.user_data[key] = value
-                updated = True
-                print(f"Updated {key}: {value}")
-        
-        if updated:
-            self.save_user_data()
+                changes[key] = value
+                log.info(f"Updated {key}: {value}")
         
-        return updated
+        self.user_store.update(self.user_id, changes)
+        return bool(changes)
+    
+    def show_user_data(self):
+        """Print the stored profile"""
+        if not self.user_data:
+            print("No personal data saved yet")
+            return
+        for key, value in self.user_data.items():
+            print(f"  {key}: {value}")
     
     def get_user_context(self) -> str:
         """Get user context for AI responses"""
@@ -182,333 +2432,1476 @@ class TestudoAI:
     
     def needs_time_info(self, prompt: str) -> bool:
         """Check if the question is asking for time/date information"""
-        time_keywords = [
-            "what time", "what's the time", "current time", "time is it",
-            "what date", "what's the date", "current date", "date today",
-            "today", "now", "current", "when is it"
-        ]
+        return self.intents.match(prompt) == "time"
+    
+    def _use_models(self, available_models: List[str]):
+        """Pick a model from the server's model ids"""
+        if self.model_name not in available_models and available_models:
+            self.model_name = available_models[0]
+            log.info(f"Using model: {self.model_name}")
+    
+    def _store_models(self, listing: Dict[str, Any]) -> List[str]:
+        """Remember a /v1/models listing and return its ids"""
+        available_models = [model["id"] for model in listing.get("data", [])]
+        log.info(f"LM Studio connected. Models: {available_models}")
+        self.model_cache.store(self.lm_studio_url, available_models)
+        return available_models
+    
+    def _cached_models(self) -> Tuple[Optional[List[str]], bool]:
+        """Use the cached listing if there is one; (ids, needs refresh)"""
+        available_models, fresh = self.model_cache.get(self.lm_studio_url)
+        if available_models is None:
+            return None, False
+        log.debug(f"LM Studio models (cached): {available_models}")
+        self._use_models(available_models)
+        return available_models, not fresh and self.model_cache.claim_refresh(self.lm_studio_url)
+    
+    def _fetch_models(self) -> bool:
+        """Ask the pool's endpoints in turn; the first listing wins"""
+        for endpoint in self.llm.endpoints:
+            try:
+                response = self.http.get(f"{endpoint.url}/v1/models", read_timeout=5)
+                if response.status_code == 200:
+                    self._use_models(self._store_models(response.json()))
+                    return True
+                else:
+                    log.error(f"LM Studio error: {response.status_code}")
+            except Exception as e:
+                log.error(f"Cannot connect to LM Studio at {endpoint.url}: {e}")
+        self.model_cache.forget(self.lm_studio_url)
+        return False
+    
+    async def _fetch_models_async(self) -> bool:
+        for endpoint in self.llm.endpoints:
+            try:
+                session = await self.http.async_session()
+                async with session.get(f"{endpoint.url}/v1/models",
+                                       timeout=self.http.async_timeout(5)) as response:
+                    if response.status == 200:
+                        self._use_models(self._store_models(await response.json(content_type=None)))
+                        return True
+                    log.error(f"LM Studio error: {response.status}")
+            except Exception as e:
+                log.error(f"Cannot connect to LM Studio at {endpoint.url}: {e}")
+        self.model_cache.forget(self.lm_studio_url)
+        return False
+    
+    def check_connection(self, refresh: bool = False) -> bool:
+        """Check if LM Studio is running
         
-        prompt_lower = prompt.lower()
-        return any(keyword in prompt_lower for keyword in time_keywords)
-    def check_connection(self) -> bool:
-        """Check if LM Studio is running"""
-        try:
-            response = requests.get(f"{self.lm_studio_url}/v1/models", timeout=5)
-            if response.status_code == 200:
-                models = response.json()
-                available_models = [model["id"] for model in models.get("data", [])]
-                print(f" LM Studio connected. Models: {available_models}")
-                
-                if self.model_name not in available_models and available_models:
-                    self.model_name = available_models[0]
-                    print(f"Using model: {self.model_name}")
-                
+        A cached model listing answers at once; a stale one is refreshed
+        on a background thread. refresh=True always asks the server.
+        """
+        if not refresh:
+            available_models, stale = self._cached_models()
+            if available_models is not None:
+                if stale:
+                    threading.Thread(target=self._fetch_models, daemon=True).start()
                 return True
-            else:
-                print(f" LM Studio error: {response.status_code}")
-                return False
-        except Exception as e:
-            print(f" Cannot connect to LM Studio: {e}")
-            return False
+        return self._fetch_models()
+    
+    async def check_connection_async(self, refresh: bool = False) -> bool:
+        """Check if LM Studio is running without blocking the event loop"""
+        if not refresh:
+            available_models, stale = self._cached_models()
+            if available_models is not None:
+                if stale:
+                    self._model_refresh = asyncio.create_task(self._fetch_models_async())
+                return True
+        return await self._fetch_models_async()
+    
+    def build_messages(self, prompt: str, keep_history: bool = True) -> List[Dict[str, str]]:
+        """Build the chat messages sent to LM Studio
+        
+        The stable layout keeps the prompt prefix byte-identical between
+        turns: the fixed system prompt, then the user facts as their own
+        message, then history that slides a block at a time.
+        """
+        if self.prompt_layout == "stable":
+            facts = self.get_user_context().strip() or "Nothing is known about the user yet."
+            messages = [{"role": "system", "content": self.system_prompt},
+                        {"role": "system", "content": facts}]
+        else:
+            system_prompt_with_context = self.system_prompt
+            user_context = self.get_user_context()
+            if user_context:
+                system_prompt_with_context += f" {user_context}"
+            messages = [{"role": "system", "content": system_prompt_with_context}]
+        
+        if keep_history:
+            messages.extend(self.memory.window())
+        
+        messages.append({"role": "user", "content": prompt})
+        return messages
+    
+    def _remember(self, prompt: str, reply: str, keep_history: bool):
+        """Add one user/assistant exchange to the history"""
+        if keep_history:
+            self.memory.add_exchange(prompt, reply)
+    
+    def _local_reply(self, prompt: str, keep_history: bool) -> Optional[str]:
+        """Store personal info and answer profile and clock questions without the LLM"""
+        with METRICS.span("extract"):
+            personal_info = self.extract_personal_info(prompt)
+        if personal_info:
+            self.update_user_data(personal_info)
+
+        routed = self.intents.route(prompt, self.user_data)
+        if routed:
+            intent, reply = routed
+            if intent == "time":
+                METRICS.count("time_shortcuts")
+            METRICS.count(f"intent_{intent}")
+            self._route("local")
+            log.info(f"Testudo: {reply}")
+            self._remember(prompt, reply, keep_history)
+            return reply
+        
+        return None
+    
+    def _completion_payload(self, prompt: str, keep_history: bool, stream: bool = False) -> Dict[str, Any]:
+        """Request body for /v1/chat/completions"""
+        messages = self.build_messages(prompt, keep_history)
+        payload = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 150
+        }
+        if stream:
+            payload["stream"] = True
+        if self.prompt_hints:
+            payload["cache_prompt"] = True
+            payload["n_keep"] = estimate_tokens(self.system_prompt) + 4
+        if METRICS.enabled:
+            self._count_prompt_reuse(messages)
+        return payload
+    
+    def _count_prompt_reuse(self, messages: List[Dict[str, str]]):
+        """Estimate how much of this prompt repeats the previous one's prefix"""
+        reused = 0
+        for new, old in zip(messages, self._last_messages):
+            if new != old:
+                break
+            reused += estimate_tokens(new["content"]) + 4
+        METRICS.count("prompt_tokens", sum(estimate_tokens(m["content"]) + 4 for m in messages))
+        METRICS.count("prompt_tokens_reused", reused)
+        self._last_messages = messages
+    
+    def _web_enhanced(self, prompt: str, search_result: str) -> str:
+        """Turn a search result into Testudo's reply"""
+        if MATCHER.match(prompt)["w_question"]:
+            enhanced_reply = search_result
+        else:
+            enhanced_reply = f"I don't know that off the top of my head, but I found: {search_result}"
+        
+        enhanced_reply = self.filter_asterisk_actions(enhanced_reply)
+        log.info(f"Testudo (web-enhanced): {enhanced_reply}")
+        return enhanced_reply
+    
+    def _route(self, route: str):
+        """Record which path produced the reply"""
+        self.last_route = route
+        self.route_counts[route] += 1
+        METRICS.count(f"route_{route}")
+        log.debug(f"🏁 Answered by {route} ({self.search_policy})")
+    
+    def _usable(self, reply: Optional[str]) -> bool:
+        """An LLM reply that doesn't just say it doesn't know"""
+        return bool(reply) and not MATCHER.match(reply)["unknown"]
+    
+    def _races_search(self, prompt: str, auto_search: bool) -> bool:
+        return auto_search and self.search_policy != "sequential" and MATCHER.match(prompt)["w_question"]
+    
+    def _cached_reply(self, payload: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+        """Look the request up in the response cache unless replies should vary"""
+        if not self.cache_replies:
+            return False, None
+        return self.response_cache.lookup(payload)
+    
+    def _cache_reply(self, payload: Dict[str, Any], reply: Optional[str]):
+        if self.cache_replies:
+            self.response_cache.store(payload, reply)
+    
+    def _llm_reply(self, prompt: str, keep_history: bool) -> Optional[str]:
+        """One blocking completion request, filtered"""
+        payload = self._completion_payload(prompt, keep_history)
+        found, reply = self._cached_reply(payload)
+        if found:
+            return reply
+        
+        with METRICS.span("llm"):
+            status, data = self.llm.post_json("/v1/chat/completions", payload)
+        if status != 200:
+            log.error(f"AI request failed: {status}")
+            return None
+        reply = self.filter_asterisk_actions(data["choices"][0]["message"]["content"])
+        log.info(f"Testudo: {reply}")
+        self._cache_reply(payload, reply)
+        return reply
+    
+    async def _llm_reply_async(self, prompt: str, keep_history: bool) -> Optional[str]:
+        """One completion request on the asyncio session, filtered"""
+        payload = self._completion_payload(prompt, keep_history)
+        found, reply = self._cached_reply(payload)
+        if found:
+            return reply
+        
+        async with self.llm_gate or nullcontext(), METRICS.span("llm"):
+            status, data = await self.llm.post_json_async("/v1/chat/completions", payload)
+        if status != 200:
+            log.error(f"AI request failed: {status}")
+            return None
+        reply = self.filter_asterisk_actions(data["choices"][0]["message"]["content"])
+        log.info(f"Testudo: {reply}")
+        self._cache_reply(payload, reply)
+        return reply
+    
+    def _search_then_llm(self, prompt: str, keep_history: bool) -> Optional[str]:
+        """search-first policy: only ask the LLM when search has no answer"""
+        search_result = self.search_google(prompt)
+        if search_result:
+            self._route("search")
+            return self._web_enhanced(prompt, search_result)
+        self._route("llm")
+        return self._llm_reply(prompt, keep_history)
+    
+    def _speculate(self, prompt: str, keep_history: bool) -> Optional[str]:
+        """speculative policy: run search and LLM side by side, keep the first usable answer"""
+        if self._search_pool is None:
+            self._search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="testudo-search")
+        llm = self._search_pool.submit(self._llm_reply, prompt, keep_history)
+        search = self._search_pool.submit(self.search_google, prompt)
+        
+        pending = {llm, search}
+        while pending:
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            if search in done and search.exception() is None and search.result():
+                llm.cancel()
+                self._route("search")
+                return self._web_enhanced(prompt, search.result())
+            if llm in done and llm.exception() is None and self._usable(llm.result()):
+                search.cancel()
+                self._route("llm")
+                return llm.result()
+        
+        self._route("llm")
+        return llm.result()
+    
+    async def _speculate_async(self, prompt: str, keep_history: bool) -> Optional[str]:
+        """speculative policy on the event loop; the losing request is cancelled"""
+        llm = asyncio.create_task(self._llm_reply_async(prompt, keep_history))
+        search = asyncio.create_task(self.search_google_async(prompt))
+        
+        pending = {llm, search}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if search in done and search.exception() is None and search.result():
+                    self._route("search")
+                    return self._web_enhanced(prompt, search.result())
+                if llm in done and llm.exception() is None and self._usable(llm.result()):
+                    self._route("llm")
+                    return llm.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        self._route("llm")
+        return llm.result()
     
     def ask_ai(self, prompt: str, keep_history: bool = True, auto_search: bool = True) -> Optional[str]:
         """Ask AI a question with optional web search fallback and personal data extraction"""
         try:
-          
-            personal_info = self.extract_personal_info(prompt)
-            if personal_info:
-                self.update_user_data(personal_info)
+            local_reply = self._local_reply(prompt, keep_history)
+            if local_reply:
+                return local_reply
             
-
-            if self.needs_time_info(prompt):
-                time_info = self.get_istanbul_time_detailed()
-                print(f"Current time: {time_info}")
-                reply = f"It's currently {time_info}."
-                
-                if keep_history:
-                    self.conversation_history.append({"role": "user", "content": prompt})
-                    self.conversation_history.append({"role": "assistant", "content": reply})
-                
+            if self._races_search(prompt, auto_search):
+                if self.search_policy == "search-first":
+                    reply = self._search_then_llm(prompt, keep_history)
+                else:
+                    reply = self._speculate(prompt, keep_history)
+                if reply:
+                    self._remember(prompt, reply, keep_history)
                 return reply
             
-            url = f"{self.lm_studio_url}/v1/chat/completions"
-            headers = {"Content-Type": "application/json"}
-            
-
-            system_prompt_with_context = self.system_prompt
-            user_context = self.get_user_context()
-            if user_context:
-                system_prompt_with_context += f" {user_context}"
-            
-            messages = [{"role": "system", "content": system_prompt_with_context}]
-            
-            if keep_history:
-                messages.extend(self.conversation_history[-8:]) 
-            
-            messages.append({"role": "user", "content": prompt})
+            reply = self._llm_reply(prompt, keep_history)
+            if reply is None:
+                return None
             
-            payload = {
-                "model": self.model_name,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 150
-            }
-
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            if auto_search and self.should_search_web(reply, prompt):
+                METRICS.count("search_fallbacks")
+                log.info("Searching Google for more information...")
+                search_result = self.search_google(prompt)
+                if search_result:
+                    reply = self._web_enhanced(prompt, search_result)
+                self._route("search" if search_result else "llm")
+            else:
+                self._route("llm")
             
-            if response.status_code == 200:
-                reply = response.json()["choices"][0]["message"]["content"]
-                
-
-                reply = self.filter_asterisk_actions(reply)
+            self._remember(prompt, reply, keep_history)
+            return reply
                 
-                print(f" Testudo: {reply}")
-                
-        
-                if auto_search and self.should_search_web(reply, prompt):
-                    print(" Searching Google for more information...")
-                    search_result = self.search_google(prompt)
-                    
+        except Exception as e:
+            log.error(f"AI error: {e}")
+            return None
+    
+    async def ask_ai_async(self, prompt: str, keep_history: bool = True, auto_search: bool = True) -> Optional[str]:
+        """ask_ai on the shared asyncio session, so concurrent chats don't block each other"""
+        try:
+            local_reply = self._local_reply(prompt, keep_history)
+            if local_reply:
+                return local_reply
+            
+            if self._races_search(prompt, auto_search):
+                if self.search_policy == "search-first":
+                    search_result = await self.search_google_async(prompt)
                     if search_result:
-                     question_lower = prompt.lower().strip()
-                        w_words = ["who", "what", "when", "where", "why", "which"]
-                        is_w_question = any(question_lower.startswith(w_word) for w_word in w_words)
-                        
-                        if is_w_question:
-                            enhanced_reply = search_result
-                        else:
-                            enhanced_reply = f"I don't know that off the top of my head, but I found: {search_result}"
-                        
-                     
-                        enhanced_reply = self.filter_asterisk_actions(enhanced_reply)
-                        
-                        print(f"Testudo (web-enhanced): {enhanced_reply}")
-                        
-                        if keep_history:
-                            self.conversation_history.append({"role": "user", "content": prompt})
-                            self.conversation_history.append({"role": "assistant", "content": enhanced_reply})
-                        
-                        return enhanced_reply
+                        self._route("search")
+                        reply = self._web_enhanced(prompt, search_result)
                     else:
-                        
-                        if keep_history:
-                            self.conversation_history.append({"role": "user", "content": prompt})
-                            self.conversation_history.append({"role": "assistant", "content": reply})
-                        return reply
+                        self._route("llm")
+                        reply = await self._llm_reply_async(prompt, keep_history)
                 else:
-                   
-                    if keep_history:
-                        self.conversation_history.append({"role": "user", "content": prompt})
-                        self.conversation_history.append({"role": "assistant", "content": reply})
-                    return reply
-                
-            else:
-                print(f"AI request failed: {response.status_code}")
+                    reply = await self._speculate_async(prompt, keep_history)
+                if reply:
+                    self._remember(prompt, reply, keep_history)
+                return reply
+            
+            reply = await self._llm_reply_async(prompt, keep_history)
+            if reply is None:
                 return None
-                
+            
+            if auto_search and self.should_search_web(reply, prompt):
+                METRICS.count("search_fallbacks")
+                log.info("Searching Google for more information...")
+                search_result = await self.search_google_async(prompt)
+                if search_result:
+                    reply = self._web_enhanced(prompt, search_result)
+                self._route("search" if search_result else "llm")
+            else:
+                self._route("llm")
+            
+            self._remember(prompt, reply, keep_history)
+            return reply
+        
+        except ServiceOverloaded:
+            raise
         except Exception as e:
-            print(f"AI error: {e}")
+            log.error(f"AI error: {e}")
             return None
     
-    async def speak(self, text: str, filename: str = "response.wav") -> bool:
-        """Convert text to speech"""
+    async def speak(self, text: str, filename: Optional[str] = None) -> Optional[str]:
+        """Convert text to speech and return the audio path
+        
+        Without a filename the content-addressed cache file itself is
+        returned, so concurrent chats never share an output file.
+        """
         try:
             if not text:
-                return False
+                return None
             
-            communicate = edge_tts.Communicate(text, voice=self.voice)
-            await communicate.save(filename)
-            print(f"Audio saved: {filename}")
-            return True
+            path = self.audio_cache.get(self.voice, text)
+            METRICS.count("audio_cache_hits" if path else "audio_cache_misses")
+            if path:
+                log.debug(f"🔁 Cached audio: {path}")
+            else:
+                tmp_path = self.audio_cache.temp_path()
+                communicate = edge_tts.Communicate(text, voice=self.voice)
+                try:
+                    async with METRICS.span("tts"):
+                        await communicate.save(tmp_path)
+                except Exception:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                path = self.audio_cache.put_file(self.voice, text, tmp_path)
+            
+            if filename:
+                shutil.copyfile(path, filename)
+                path = filename
+            log.info(f"Audio saved: {path}")
+            self.last_audio = path
+            return path
         except Exception as e:
-            print(f"TTS error: {e}")
-            return False
+            log.error(f"TTS error: {e}")
+            return None
+    
+    async def speak_device(self, text: str, trim: bool = True) -> Optional[bytes]:
+        """Speech for text as a WAV buffer the ESP32 can play as is"""
+        path = await self.speak(text)
+        if not path:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return to_device_wav(f.read(), trim=trim)
+        except Exception as e:
+            log.error(f"Audio conversion error: {e}")
+            return None
+    
+    async def prewarm_audio(self, phrases: Iterable[str], concurrency: int = 4) -> int:
+        """Synthesize phrases that are not cached yet; returns how many were made"""
+        limit = asyncio.Semaphore(concurrency)
+        missing = [p for p in dict.fromkeys(phrases) if p and not self.audio_cache.has(self.voice, p)]
+        
+        async def warm(phrase: str):
+            async with limit:
+                return await self.speak(phrase)
+        
+        results = await asyncio.gather(*(warm(p) for p in missing))
+        made = sum(1 for r in results if r)
+        log.info(f"🔥 Pre-warmed {made} of {len(missing)} missing phrases")
+        return made
+    
+    async def stream_ai(self, prompt: str, keep_history: bool = True,
+                        auto_search: bool = False) -> AsyncIterator[str]:
+        """Ask AI with a streamed completion and yield the reply sentence by sentence
+        
+        With auto_search, W questions go through ask_ai_async (a search
+        answer has no stream to follow) and a reply that says it doesn't
+        know is followed by what the search found.
+        """
+        if auto_search and MATCHER.match(prompt)["w_question"]:
+            reply = await self.ask_ai_async(prompt, keep_history, auto_search=True)
+            for sentence in SentenceSplitter.split(reply or ""):
+                yield sentence
+            return
+        
+        local_reply = self._local_reply(prompt, keep_history)
+        if local_reply:
+            yield local_reply
+            return
+        
+        payload = self._completion_payload(prompt, keep_history, stream=True)
+        found, cached = self._cached_reply(payload)
+        sentences = []
+        route = "llm"
+        try:
+            if found:
+                for sentence in SentenceSplitter.split(cached or ""):
+                    sentences.append(sentence)
+                    yield sentence
+            else:
+                async for sentence in self._stream_completion(payload):
+                    sentences.append(sentence)
+                    yield sentence
+                self._cache_reply(payload, " ".join(sentences))
+            
+            if auto_search and sentences and not self._usable(" ".join(sentences)):
+                METRICS.count("search_fallbacks")
+                log.info("Searching Google for more information...")
+                search_result = await self.search_google_async(prompt)
+                if search_result:
+                    route = "search"
+                    found_text = self.filter_asterisk_actions(f"But I found: {search_result}")
+                    for sentence in SentenceSplitter.split(found_text):
+                        sentences.append(sentence)
+                        yield sentence
+        except ServiceOverloaded:
+            raise
+        except Exception as e:
+            log.error(f"AI error: {e}")
+        finally:
+            if sentences:
+                reply = " ".join(sentences)
+                log.info(f"Testudo: {reply}")
+                self._route(route)
+                self._remember(prompt, reply, keep_history)
+    
+    async def _stream_completion(self, payload: Dict[str, Any]) -> AsyncIterator[str]:
+        """Sentences of a streamed completion, asterisk actions filtered out"""
+        asterisks = AsteriskFilter()
+        splitter = SentenceSplitter()
+        first = True
+        async with self.llm_gate or nullcontext():
+            start = time.perf_counter()
+            async with self.llm.stream("/v1/chat/completions", payload) as response:
+                if response.status != 200:
+                    log.error(f"AI request failed: {response.status}")
+                    return
+                
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    
+                    delta = json.loads(data)["choices"][0].get("delta", {})
+                    token = delta.get("content")
+                    if not token:
+                        continue
+                    
+                    for sentence in splitter.feed(asterisks.feed(token)):
+                        if first:
+                            METRICS.observe("llm_first_sentence", time.perf_counter() - start)
+                            first = False
+                        yield sentence
+            METRICS.observe("llm_stream", time.perf_counter() - start)
+        
+        rest = splitter.flush()
+        tail = self.filter_asterisk_actions(f"{rest or ''} {asterisks.flush()}")
+        if tail:
+            yield tail
+    
+    async def synthesize_stream(self, text: str) -> AsyncIterator[bytes]:
+        """Yield TTS audio chunks for text as edge_tts produces them (or from the cache)"""
+        cached = self.audio_cache.get_bytes(self.voice, text)
+        METRICS.count("audio_cache_hits" if cached is not None else "audio_cache_misses")
+        if cached is not None:
+            yield cached
+            return
+        
+        chunks = []
+        start = time.perf_counter()
+        communicate = edge_tts.Communicate(text, voice=self.voice)
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                if not chunks:
+                    METRICS.observe("tts_first_chunk", time.perf_counter() - start)
+                chunks.append(chunk["data"])
+                yield chunk["data"]
+        METRICS.observe("tts", time.perf_counter() - start)
+        self.audio_cache.put(self.voice, text, b"".join(chunks))
+    
+    async def speak_stream(self, sentences: AsyncIterator[str]) -> AsyncIterator[bytes]:
+        """Synthesize each sentence as soon as it arrives and yield audio in order"""
+        pending: asyncio.Queue = asyncio.Queue()
+        tasks = []
+        
+        async def synthesize(text: str, out: asyncio.Queue):
+            try:
+                async for chunk in self.synthesize_stream(text):
+                    await out.put(chunk)
+            except Exception as e:
+                log.error(f"TTS error: {e}")
+            finally:
+                await out.put(None)
+        
+        async def produce():
+            try:
+                async for sentence in sentences:
+                    out: asyncio.Queue = asyncio.Queue()
+                    tasks.append(asyncio.create_task(synthesize(sentence, out)))
+                    await pending.put(out)
+            finally:
+                await pending.put(None)
+        
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                out = await pending.get()
+                if out is None:
+                    break
+                while True:
+                    chunk = await out.get()
+                    if chunk is None:
+                        break
+                    yield chunk
+            await producer
+        finally:
+            producer.cancel()
+            for task in tasks:
+                task.cancel()
+    
+    async def _sentence_audio(self, sentences: AsyncIterator[str]) -> AsyncIterator[bytes]:
+        """Whole TTS output per sentence, synthesized concurrently but yielded in order"""
+        pending: asyncio.Queue = asyncio.Queue()
+        
+        async def synthesize(text: str) -> bytes:
+            return b"".join([chunk async for chunk in self.synthesize_stream(text)])
+        
+        async def produce():
+            try:
+                async for sentence in sentences:
+                    await pending.put(asyncio.create_task(synthesize(sentence)))
+            finally:
+                await pending.put(None)
+        
+        producer = asyncio.create_task(produce())
+        tasks = []
+        try:
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                tasks.append(task)
+                try:
+                    yield await task
+                except Exception as e:
+                    log.error(f"TTS error: {e}")
+            await producer
+        finally:
+            producer.cancel()
+            for task in tasks:
+                task.cancel()
+            while not pending.empty():
+                task = pending.get_nowait()
+                if task is not None:
+                    task.cancel()
+    
+    async def speak_stream_device(self, sentences: AsyncIterator[str]) -> AsyncIterator[bytes]:
+        """Device-format WAV as a stream: the header, then 8-bit PCM sentence by sentence"""
+        yield device_wav_header()
+        async for audio in self._sentence_audio(sentences):
+            samples, rate = decode_audio(audio)
+            yield encode_device_pcm(resample(samples, rate, DEVICE_SAMPLE_RATE), normalize=False)
+    
+    async def chat_to_device(self, message: str, device: DeviceClient) -> Optional[str]:
+        """Chat and push the spoken reply to the ESP32 while it is being generated
+        
+        Returns None when there was no reply, no speech for it, or the
+        upload failed.
+        """
+        log.info(f"You: {message}")
+        sentences = []
+        chunks = 0
+        
+        async def collect():
+            async for sentence in self.stream_ai(message):
+                sentences.append(sentence)
+                yield sentence
+        
+        async def audio():
+            nonlocal chunks
+            async for chunk in self.speak_stream_device(collect()):
+                chunks += 1
+                yield chunk
+            if chunks < 2:
+                raise ValueError("no speech was produced")  # only the WAV header
+        
+        if not await device.upload_stream(audio()):
+            return None
+        return " ".join(sentences) if sentences else None
+    
+    async def chat_stream(self, message: str) -> AsyncIterator[bytes]:
+        """Streamed chat: yield reply audio while the model is still generating"""
+        log.info(f"You: {message}")
+        async for chunk in self.speak_stream(self.stream_ai(message)):
+            yield chunk
     
-    async def chat(self, message: str, with_voice: bool = True, auto_search: bool = True) -> Optional[str]:
+    async def chat(self, message: str, with_voice: bool = True, auto_search: bool = True,
+                   stream: bool = False, filename: Optional[str] = None) -> Optional[str]:
         """Complete chat interaction with optional web search"""
-        print(f"You: {message}")
+        log.info(f"You: {message}")
         
+        async with METRICS.span("chat"):
+            if stream:
+                return await self._chat_streamed(message, with_voice, auto_search, filename)
 
-        reply = self.ask_ai(message, auto_search=auto_search)
-        if not reply:
-            return None
+            reply = await self.ask_ai_async(message, auto_search=auto_search)
+            if not reply:
+                return None
+            
+            if with_voice:
+                await self.speak(reply, filename)
+            
+            return reply
+    
+    async def _chat_streamed(self, message: str, with_voice: bool, auto_search: bool,
+                             filename: Optional[str]) -> Optional[str]:
+        """Streaming chat that writes audio to a file as it is synthesized"""
+        sentences = []
+        
+        async def collect():
+            async for sentence in self.stream_ai(message, auto_search=auto_search):
+                sentences.append(sentence)
+                yield sentence
         
-  
         if with_voice:
-            await self.speak(reply)
+            path = filename or self.audio_cache.temp_path()
+            with open(path, 'wb') as f:
+                async for chunk in self.speak_stream(collect()):
+                    f.write(chunk)
+            if not sentences:
+                os.remove(path)
+            else:
+                if not filename:
+                    path = self.audio_cache.put_file(self.voice, " ".join(sentences), path)
+                log.info(f"Audio saved: {path}")
+                self.last_audio = path
+        else:
+            async for _ in collect():
+                pass
         
-        return reply
+        return " ".join(sentences) if sentences else None
+    
+    async def aclose(self):
+        """Release the pooled connections (unless the client is shared)"""
+        if self._model_refresh is not None and not self._model_refresh.done():
+            await asyncio.wait([self._model_refresh], timeout=1)
+            self._model_refresh.cancel()
+        if self._owns_llm:
+            await self.llm.aclose()
+        if self._owns_http:
+            await self.http.aclose()
+        if self._search_pool is not None:
+            self._search_pool.shutdown(wait=False, cancel_futures=True)
+    
+    @property
+    def conversation_history(self) -> List[Dict[str, str]]:
+        """Messages currently held in memory, oldest first"""
+        return list(self.memory)
     
     def clear_history(self):
         """Clear conversation memory"""
-        self.conversation_history = []
-        print("🧹 History cleared")
+        self.memory.clear()
+        log.info("🧹 History cleared")
+    
+    def parse_search_results(self, text: str) -> Optional[str]:
+        """Pick the first relevant sentence out of a Google results page"""
+        scanner = SnippetScanner()
+        scanner.feed(text)
+        return GoogleSearch.answer(scanner)
+    
+    def _cached_search(self, query: str) -> Tuple[bool, Optional[str]]:
+        found, answer = self.search_cache.lookup(query)
+        METRICS.count("search_cache_hits" if found else "search_cache_misses")
+        if found:
+            log.debug(f"🔍 Cached answer: {answer}" if answer else "🔍 Cached: no clear answer")
+        return found, answer
     
     def search_google(self, query: str) -> Optional[str]:
-        """Search Google and return first relevant sentence"""
-        try:
-
-            search_query = quote_plus(query)
-            url = f"https://www.google.com/search?q={search_query}"
-            
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            
-            response = requests.get(url, headers=headers, timeout=10)
-            
-            if response.status_code == 200:
-
-                text = response.text
-                
-               
-                snippet_patterns = [
-                    r'class="BNeawe[^"]*"[^>]*>([^<]+)</span>',
-                    r'class="hgKElc"[^>]*>([^<]+)</span>',
-                    r'class="st"[^>]*>([^<]+)</span>',
-                ]
-                
-                for pattern in snippet_patterns:
-                    matches = re.findall(pattern, text)
-                    if matches:
-                     
-                        for match in matches:
-                            sentence = match.strip()
-
-                            if len(sentence) > 20 and not any(skip in sentence.lower() for skip in ['search', 'more', 'about', 'sign in', 'images']):
-                         
-                                sentence = sentence.replace('&quot;', '"').replace('&amp;', '&').replace('&#39;', "'")
-                                print(f"🔍 Google says: {sentence}")
-                                return sentence
-                
-               
-                div_pattern = r'<div[^>]*>([^<]+)</div>'
-                div_matches = re.findall(div_pattern, text)
-                for match in div_matches:
-                    sentence = match.strip()
-                    if len(sentence) > 30 and len(sentence) < 200:
-                        if not any(skip in sentence.lower() for skip in ['search', 'more', 'about', 'sign in', 'images', 'videos']):
-                            sentence = sentence.replace('&quot;', '"').replace('&amp;', '&').replace('&#39;', "'")
-                            print(f"🔍 Google found: {sentence}")
-                            return sentence
-                
-                print("🔍 No clear answer found in search results")
-                return None
-                
-            else:
-                print(f"❌ Google search failed: {response.status_code}")
-                return None
-                
-        except Exception as e:
-            print(f"❌ Search error: {e}")
-            return None
+        """Ask each search backend in turn (local notes first, Google last) for an answer"""
+        checked_cache = False
+        for backend in self.search_backends:
+            if backend.cacheable and not checked_cache:
+                checked_cache = True
+                found, answer = self._cached_search(query)
+                if found:
+                    return answer
+            try:
+                with METRICS.span(f"search_{backend.name}"):
+                    answer = backend.search(query)
+            except Exception as e:
+                log.error(f"❌ Search error ({backend.name}): {e}")
+                continue
+            if backend.cacheable:
+                self.search_cache.store(query, answer)
+            if answer:
+                METRICS.count(f"search_{backend.name}_hits")
+                return answer
+        return None
+    
+    async def search_google_async(self, query: str) -> Optional[str]:
+        """search_google on the shared asyncio session"""
+        checked_cache = False
+        for backend in self.search_backends:
+            if backend.cacheable and not checked_cache:
+                checked_cache = True
+                found, answer = self._cached_search(query)
+                if found:
+                    return answer
+            try:
+                async with METRICS.span(f"search_{backend.name}"):
+                    answer = await backend.search_async(query)
+            except Exception as e:
+                log.error(f"❌ Search error ({backend.name}): {e}")
+                continue
+            if backend.cacheable:
+                self.search_cache.store(query, answer)
+            if answer:
+                METRICS.count(f"search_{backend.name}_hits")
+                return answer
+        return None
     
     def should_search_web(self, ai_response: str, original_question: str = "") -> bool:
         """Check if AI response indicates it doesn't know something OR if it's a W question"""
         if not ai_response:
             return False
         
-        if original_question:
-            question_lower = original_question.lower().strip()
-            w_words = ["who", "what", "when", "where", "why", "which"]
-            if any(question_lower.startswith(w_word) for w_word in w_words):
-                print(f"🔍 Detected W question: '{original_question}' - auto searching web")
-                return True
-        
-     
-        unknown_phrases = [
-            "not in my codebase",
-            "don't know",
-            "i don't know",
-            "not sure",
-            "i'm not sure",
-            "can't help",
-            "don't have information",
-            "not familiar",
-            "i don't have",
-            "beyond my knowledge",
-            "i cannot",
-            "i can't",
-            "no information",
-            "not aware",
-            "i'm not aware"
-        ]
+        if original_question and MATCHER.match(original_question)["w_question"]:
+            log.debug(f"🔍 Detected W question: '{original_question}' - auto searching web")
+            return True
         
-        response_lower = ai_response.lower()
-        return any(phrase in response_lower for phrase in unknown_phrases)
+        return MATCHER.match(ai_response)["unknown"]
 
 
-def quick_chat(message: str, model: str = "emotion-llama") -> str:
-    """Quick chat without history"""
+class SpeechToText:
+    """Speech-to-text backend for MicIngest; subclass and implement transcribe"""
 
-    time_keywords = ["what time", "what's the time", "current time", "time is it",
-                    "what date", "what's the date", "current date", "date today",
-                    "today", "now", "current", "when is it"]
-    
-    if any(keyword in message.lower() for keyword in time_keywords):
-        istanbul_tz = timezone(timedelta(hours=3))
-        now = datetime.now(istanbul_tz)
-        time_info = now.strftime("%A, %B %d, %Y at %H:%M (Istanbul time)")
-        reply = f"It's currently {time_info}."
-        print(f"Testudo: {reply}")
-        return reply
-    
-    url = "http://localhost:1234/v1/chat/completions"
-    headers = {"Content-Type": "application/json"}
-    payload = {
+    async def transcribe(self, wav: bytes) -> Optional[str]:
+        """Text spoken in a 16-bit mono WAV buffer, or None"""
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class WhisperServerSTT(SpeechToText):
+    """Any server with the OpenAI /v1/audio/transcriptions API (whisper.cpp, faster-whisper-server, ...)"""
+
+    def __init__(self,
+                 url: str = "http://localhost:8000",
+                 model: str = "whisper-1",
+                 language: str = "en",
+                 http: Optional[HttpClient] = None):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.language = language
+        self.http = http or HttpClient(per_host=2)
+
+    async def transcribe(self, wav: bytes) -> Optional[str]:
+        form = aiohttp.FormData()
+        form.add_field("file", wav, filename="speech.wav", content_type="audio/wav")
+        form.add_field("model", self.model)
+        form.add_field("language", self.language)
+        try:
+            session = await self.http.async_session()
+            async with session.post(f"{self.url}/v1/audio/transcriptions", data=form) as response:
+                if response.status != 200:
+                    log.error(f"❌ STT failed: {response.status}")
+                    return None
+                data = await response.json(content_type=None)
+            return data.get("text", "").strip() or None
+        except Exception as e:
+            log.error(f"❌ STT error: {e}")
+            return None
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+class MicIngest:
+    """Turns the device's /deneme.wav recordings into chat turns
+
+    Each fetch is a conditional GET (ETag / Last-Modified), so an unchanged
+    recording costs a 304 instead of a 160 KB download; servers without
+    validators fall back to a content hash. Only the speech part of the
+    clip, found with the same RMS dB measure serverer.ino uses for clap
+    detection, goes to the STT backend.
+    """
+
+    FRAME_MS = 16  # BUFFER_SIZE / 2 samples at 16 kHz, the device's RMS window
+    DEVICE_DB_OFFSET = 20 * math.log10(32768)  # device dB (raw int16 RMS) minus dBFS
+
+    def __init__(self,
+                 testudo: "TestudoAI",
+                 stt: SpeechToText,
+                 device_url: str = "http://testudo.local",
+                 interval: float = 1.0,
+                 threshold_db: float = 45.0,
+                 min_speech_ms: int = 300,
+                 pad_ms: int = 150,
+                 with_voice: bool = False,
+                 device: Optional[DeviceClient] = None,
+                 http: Optional[HttpClient] = None):
+        self.testudo = testudo
+        self.stt = stt
+        self.device_url = device_url.rstrip("/")
+        self.interval = interval
+        self.threshold_db = threshold_db
+        self.min_speech_ms = min_speech_ms
+        self.pad_ms = pad_ms
+        self.with_voice = with_voice
+        self.device = device
+        self.http = http or HttpClient(per_host=1, read_timeout=10)
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.digest: Optional[str] = None
+        self._wake = asyncio.Event()
+        self._running = False
+        self.stats = {"fetches": 0, "not_modified": 0, "duplicates": 0, "no_speech": 0,
+                      "transcribed": 0, "clip_seconds": 0.0, "speech_seconds": 0.0}
+
+    async def fetch(self) -> Optional[bytes]:
+        """The current recording, or None if it hasn't changed since last time"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        session = await self.http.async_session()
+        async with session.get(f"{self.device_url}/deneme.wav", headers=headers) as response:
+            self.stats["fetches"] += 1
+            if response.status == 304:
+                self.stats["not_modified"] += 1
+                return None
+            if response.status != 200:
+                log.error(f"❌ Recording fetch failed: {response.status}")
+                return None
+            data = await response.read()
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+
+        digest = hashlib.sha256(data).hexdigest()
+        if digest == self.digest:
+            self.stats["duplicates"] += 1
+            return None
+        self.digest = digest
+        return data
+
+    def speech(self, wav: bytes) -> Optional[bytes]:
+        """The speech part of a recording as a 16-bit WAV, or None if nobody spoke"""
+        samples, rate = decode_audio(wav)
+        voiced = trim_silence(samples, rate,
+                              threshold_db=self.threshold_db - self.DEVICE_DB_OFFSET,
+                              frame_ms=self.FRAME_MS, pad_ms=self.pad_ms)
+        self.stats["clip_seconds"] += len(samples) / rate
+        if len(voiced) < rate * self.min_speech_ms // 1000:
+            self.stats["no_speech"] += 1
+            return None
+        self.stats["speech_seconds"] += len(voiced) / rate
+        return encode_wav16(voiced, rate)
+
+    async def process_once(self) -> Optional[str]:
+        """Fetch, trim, transcribe and answer one new recording; returns the reply"""
+        try:
+            async with METRICS.span("ingest_fetch"):
+                wav = await self.fetch()
+            if wav is None:
+                return None
+            with METRICS.span("vad"):
+                speech = self.speech(wav)
+            if speech is None:
+                log.info("🤫 No speech in the new recording")
+                return None
+            async with METRICS.span("stt"):
+                text = await self.stt.transcribe(speech)
+            if not text:
+                return None
+            self.stats["transcribed"] += 1
+        except Exception as e:
+            log.error(f"❌ Ingest error: {e}")
+            return None
+
+        if self.device is not None:
+            return await self.testudo.chat_to_device(text, self.device)
+        return await self.testudo.chat(text, with_voice=self.with_voice)
+
+    def notify(self):
+        """Check for a new recording now instead of at the next poll"""
+        self._wake.set()
+
+    async def run(self):
+        """Poll the device until stop() is called"""
+        self._running = True
+        while self._running:
+            await self.process_once()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    async def aclose(self):
+        self.stop()
+        await self.http.aclose()
+        await self.stt.aclose()
+
+
+def load_batch(path: str) -> List[Dict[str, str]]:
+    """Batch items from a JSONL or CSV file
+
+    Each item has a "prompt" for the LLM or a fixed "text" to speak as is,
+    and optionally an "id" used in the audio file name. A JSONL line may
+    also be a bare string, taken as a prompt. CSV files need a header row.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    items = []
+    for n, row in enumerate(rows, 1):
+        if isinstance(row, str):
+            row = {"prompt": row}
+        item = {k: str(v).strip() for k, v in row.items() if k in ("id", "prompt", "text") and v}
+        if not item.get("prompt") and not item.get("text"):
+            log.warning(f"Skipping line {n} of {path}: no prompt or text")
+            continue
+        items.append(item)
+    return items
+
+
+class BatchRender:
+    """Pre-renders canned lines to device-format WAV files, concurrently
+
+    Items flow through two bounded stages joined by a queue: up to
+    llm_concurrency completions run at once, and each reply goes on to one
+    of tts_concurrency synthesis workers as soon as it arrives, so TTS
+    overlaps generation. Fixed texts skip the LLM. Every finished item is
+    written as <name>-<hash>.wav and appended to manifest.jsonl in
+    out_dir; a rerun skips items whose file is already in the manifest,
+    so an interrupted batch picks up where it stopped.
+    """
+
+    MANIFEST = "manifest.jsonl"
+
+    def __init__(self,
+                 testudo: "TestudoAI",
+                 out_dir: str = "prerendered",
+                 llm_concurrency: int = 4,
+                 tts_concurrency: int = 4,
+                 trim: bool = True):
+        self.testudo = testudo
+        self.out_dir = out_dir
+        self.llm_concurrency = llm_concurrency
+        self.tts_concurrency = tts_concurrency
+        self.trim = trim
+        self.manifest_path = os.path.join(out_dir, self.MANIFEST)
+        self.stats = {"items": 0, "skipped": 0, "rendered": 0, "failed": 0, "llm_seconds": 0.0,
+                      "tts_seconds": 0.0, "audio_seconds": 0.0, "seconds": 0.0}
+        os.makedirs(out_dir, exist_ok=True)
+
+    def key(self, item: Dict[str, str]) -> str:
+        """Hash of what decides the audio: the prompt or text, model and voice"""
+        source = f"prompt\n{item['prompt']}\n{self.testudo.model_name}" if item.get("prompt") else f"text\n{item['text']}"
+        return hashlib.sha256(f"{source}\n{self.testudo.voice}".encode('utf-8')).hexdigest()
+
+    def filename(self, item: Dict[str, str], key: str) -> str:
+        name = item.get("id") or item.get("prompt") or item["text"]
+        slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')[:40] or "line"
+        return f"{slug}-{key[:10]}.wav"
+
+    def done(self) -> Dict[str, Dict[str, Any]]:
+        """Manifest entries whose audio file is still there, by key"""
+        entries = {}
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by an interruption
+                    if os.path.exists(os.path.join(self.out_dir, entry["file"])):
+                        entries[entry["key"]] = entry
+        except FileNotFoundError:
+            pass
+        return entries
+
+    async def run(self, items: Iterable[Dict[str, str]]) -> Dict[str, Any]:
+        """Render every item not rendered yet; returns the stats"""
+        start = time.perf_counter()
+        finished = self.done()
+        prompts: asyncio.Queue = asyncio.Queue(maxsize=self.llm_concurrency * 2)
+        texts: asyncio.Queue = asyncio.Queue(maxsize=self.tts_concurrency * 2)
+
+        async def feed():
+            for item in items:
+                self.stats["items"] += 1
+                key = self.key(item)
+                if key in finished:
+                    self.stats["skipped"] += 1
+                    continue
+                finished[key] = item
+                if item.get("prompt"):
+                    await prompts.put((key, item))
+                else:
+                    await texts.put((key, item, item["text"], 0.0))
+            for _ in range(self.llm_concurrency):
+                await prompts.put(None)
+
+        async def generate():
+            while True:
+                job = await prompts.get()
+                if job is None:
+                    return
+                key, item = job
+                started = time.perf_counter()
+                reply = await self.testudo.ask_ai_async(item["prompt"], keep_history=False, auto_search=False)
+                if reply:
+                    await texts.put((key, item, reply, time.perf_counter() - started))
+                else:
+                    self._failed(item, "no reply")
+
+        async def synthesize(manifest):
+            while True:
+                job = await texts.get()
+                if job is None:
+                    return
+                key, item, text, llm_seconds = job
+                started = time.perf_counter()
+                path = await self.testudo.speak(text)
+                if not path:
+                    self._failed(item, "no audio")
+                    continue
+                try:
+                    entry = await asyncio.to_thread(self._write, key, item, text, path)
+                except Exception as e:
+                    self._failed(item, str(e))
+                    continue
+                entry.update(llm_seconds=round(llm_seconds, 3), tts_seconds=round(time.perf_counter() - started, 3))
+                manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                manifest.flush()
+                self.stats["rendered"] += 1
+                self.stats["llm_seconds"] += llm_seconds
+                self.stats["tts_seconds"] += entry["tts_seconds"]
+                self.stats["audio_seconds"] += entry["audio_seconds"]
+                if self.stats["rendered"] % 25 == 0:
+                    log.info(f"🎙️ Rendered {self.stats['rendered']} lines")
+
+        if os.path.exists(self.manifest_path) and os.path.getsize(self.manifest_path):
+            with open(self.manifest_path, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # close off a line cut short by an interruption
+        with open(self.manifest_path, 'a', encoding='utf-8') as manifest:
+            generators = [asyncio.create_task(generate()) for _ in range(self.llm_concurrency)]
+            synthesizers = [asyncio.create_task(synthesize(manifest)) for _ in range(self.tts_concurrency)]
+            try:
+                await asyncio.gather(feed(), *generators)
+                for _ in range(self.tts_concurrency):
+                    await texts.put(None)
+                await asyncio.gather(*synthesizers)
+            finally:
+                for task in generators + synthesizers:
+                    task.cancel()
+
+        self.stats["seconds"] = time.perf_counter() - start
+        log.info(self.report(), extra={k: round(v, 3) for k, v in self.stats.items()})
+        return self.stats
+
+    def _write(self, key: str, item: Dict[str, str], text: str, path: str) -> Dict[str, Any]:
+        """Transcode cached TTS output to a device WAV next to the manifest"""
+        with open(path, 'rb') as f:
+            wav = to_device_wav(f.read(), trim=self.trim)
+        name = self.filename(item, key)
+        tmp_path = os.path.join(self.out_dir, name + ".part")
+        with open(tmp_path, 'wb') as f:
+            f.write(wav)
+        os.replace(tmp_path, os.path.join(self.out_dir, name))
+        return {"key": key, "id": item.get("id"), "prompt": item.get("prompt"), "text": text,
+                "voice": self.testudo.voice, "file": name, "bytes": len(wav),
+                "audio_seconds": round((len(wav) - 44) / DEVICE_SAMPLE_RATE, 3)}
+
+    def _failed(self, item: Dict[str, str], reason: str):
+        self.stats["failed"] += 1
+        log.error(f"❌ Could not render {item.get('id') or item.get('prompt') or item['text']!r}: {reason}")
+
+    def report(self) -> str:
+        s = self.stats
+        seconds = s["seconds"] or 1e-9
+        return (f"📦 {s['rendered']} rendered, {s['skipped']} already done, {s['failed']} failed "
+                f"in {s['seconds']:.1f}s: {s['rendered'] / seconds:.2f} lines/s, "
+                f"{s['audio_seconds'] / seconds:.1f}s of audio per second")
+
+
+async def render_batch(path: str, out_dir: str = "prerendered", lm_studio_url: Union[str, List[str]] = LM_STUDIO_URL,
+                       llm_concurrency: int = 4, tts_concurrency: int = 4, **testudo_options) -> Dict[str, Any]:
+    """Pre-render a JSONL/CSV batch file (python ai.py batch <file> [out_dir])"""
+    items = load_batch(path)
+    testudo = TestudoAI(lm_studio_url=lm_studio_url, user_store=UserStore(":memory:"),
+                        audio_cache=AudioCache(os.path.join(out_dir, "tts_cache")), **testudo_options)
+    try:
+        if any(item.get("prompt") for item in items) and not await testudo.check_connection_async():
+            log.warning("Start LM Studio first!")
+            return {}
+        return await BatchRender(testudo, out_dir, llm_concurrency, tts_concurrency).run(items)
+    finally:
+        await testudo.aclose()
+        testudo.user_store.close()
+
+
+class Session:
+    """One warm TestudoAI per device, with its own lock so turns stay in order"""
+
+    def __init__(self, testudo: "TestudoAI"):
+        self.testudo = testudo
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.turns = 0
+
+
+class TestudoService:
+    """Long-running HTTP service keeping warm sessions for many turtles
+
+    Sessions are keyed by device id and share one HTTP pool, user store
+    and caches, while each keeps its own history and profile. All LM Studio
+    traffic goes through one RequestGate; when its queue is full /chat
+    answers 503 with Retry-After so devices back off. lm_studio_url may
+    list several servers, which share the load through one LLMPool.
+    Sessions idle for idle_timeout seconds, or beyond max_sessions, are
+    dropped.
+    """
+
+    def __init__(self,
+                 lm_studio_url: Union[str, List[str]] = LM_STUDIO_URL,
+                 model_name: str = "emotion-llama",
+                 max_concurrent: int = 4,
+                 max_queued: int = 32,
+                 max_sessions: int = 100,
+                 idle_timeout: float = 30 * 60,
+                 user_store_file: str = "user_data.db",
+                 hedge_after: Optional[float] = None,
+                 **testudo_options):
+        self.model_name = model_name
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.testudo_options = testudo_options
+        self.gate = RequestGate(max_concurrent, max_queued)
+        self.http = HttpClient(pool_size=max_concurrent * 4, per_host=max_concurrent * 2)
+        self.llm = LLMPool(lm_studio_url, self.http, hedge_after=hedge_after)
+        self.lm_studio_url = self.llm.url
+        self.user_store = open_user_store(user_store_file)
+        self.search_cache = default_search_cache()
+        self.response_cache = ResponseCache()
+        self.audio_cache = AudioCache()
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.evicted = 0
+        self._evictor: Optional[asyncio.Task] = None
+
+        self.app = aiohttp.web.Application()
+        self.app.router.add_post("/chat", self.handle_chat)
+        self.app.router.add_get("/health", self.handle_health)
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        self.app.router.add_get("/metrics.json", self.handle_metrics_json)
+        self.app.on_startup.append(self._on_startup)
+        self.app.on_cleanup.append(self._on_cleanup)
+
+    def session(self, device_id: str) -> Session:
+        """Warm session for device_id, created on first use"""
+        session = self.sessions.get(device_id)
+        if session is None:
+            testudo = TestudoAI(llm_pool=self.llm,
+                                model_name=self.model_name,
+                                user_id=device_id,
+                                user_store=self.user_store,
+                                http=self.http,
+                                search_cache=self.search_cache,
+                                response_cache=self.response_cache,
+                                audio_cache=self.audio_cache,
+                                llm_gate=self.gate,
+                                **self.testudo_options)
+            session = self.sessions[device_id] = Session(testudo)
+            while len(self.sessions) > self.max_sessions:
+                self._drop(next(iter(self.sessions)))
+        self.sessions.move_to_end(device_id)
+        session.last_used = time.monotonic()
+        return session
+
+    def _drop(self, device_id: str):
+        session = self.sessions.pop(device_id)
+        self.evicted += 1
+        asyncio.ensure_future(session.testudo.aclose())
+        log.info(f"💤 Dropped idle session {device_id}")
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        for device_id in [d for d, s in self.sessions.items() if s.last_used < cutoff and not s.lock.locked()]:
+            self._drop(device_id)
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(max(1.0, self.idle_timeout / 4))
+            self.evict_idle()
+
+    async def _on_startup(self, app):
+        probe = TestudoAI(llm_pool=self.llm, model_name=self.model_name,
+                          user_store=self.user_store, http=self.http,
+                          search_cache=self.search_cache, response_cache=self.response_cache,
+                          audio_cache=self.audio_cache)
+        if await probe.check_connection_async():
+            self.model_name = probe.model_name
+        else:
+            log.warning("Start LM Studio first! Serving anyway, requests will fail until it is up")
+        self._evictor = asyncio.create_task(self._evict_loop())
+
+    async def _on_cleanup(self, app):
+        if self._evictor is not None:
+            self._evictor.cancel()
+        await self.llm.aclose()
+        await self.http.aclose()
+        self.user_store.flush()
+        self.search_cache.flush()
+
+    async def handle_chat(self, request):
+        try:
+            body = await request.json()
+        except Exception:
+            return aiohttp.web.json_response({"error": "expected a JSON body"}, status=400)
+        message = (body.get("message") or "").strip()
+        device_id = str(body.get("device_id") or "default")
+        if not message:
+            return aiohttp.web.json_response({"error": "message is required"}, status=400)
+
+        session = self.session(device_id)
+        try:
+            async with session.lock:
+                reply = await session.testudo.chat(message, with_voice=bool(body.get("voice", False)))
+                session.turns += 1
+                audio = session.testudo.last_audio if body.get("voice") else None
+        except ServiceOverloaded as e:
+            return aiohttp.web.json_response({"error": str(e)}, status=503, headers={"Retry-After": "1"})
+        finally:
+            session.last_used = time.monotonic()
+
+        if reply is None:
+            return aiohttp.web.json_response({"error": "no reply"}, status=502)
+        return aiohttp.web.json_response({"device_id": device_id, "reply": reply, "audio": audio})
+
+    async def handle_health(self, request):
+        return aiohttp.web.json_response({"sessions": len(self.sessions),
+                                          "evicted": self.evicted,
+                                          "model": self.model_name,
+                                          "llm": self.gate.stats(),
+                                          "endpoints": self.llm.stats()})
+
+    async def handle_metrics(self, request):
+        """Stage latencies and counters for a Prometheus scrape"""
+        return aiohttp.web.Response(text=METRICS.prometheus(), content_type="text/plain",
+                                    headers={"X-Content-Type-Options": "nosniff"})
+
+    async def handle_metrics_json(self, request):
+        return aiohttp.web.json_response({**METRICS.snapshot(),
+                                          "sessions": len(self.sessions),
+                                          "llm": self.gate.stats(),
+                                          "endpoints": self.llm.stats()})
+
+
+async def serve(host: str = "0.0.0.0", port: int = 8000, **options):
+    """Run TestudoService until interrupted"""
+    service = TestudoService(**options)
+    runner = aiohttp.web.AppRunner(service.app)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, host, port).start()
+    log.info(f"🐢 Testudo service listening on http://{host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def _quick_time_reply(message: str) -> Optional[str]:
+    """Answer time questions for quick_chat without the LLM"""
+    router = default_intent_router()
+    if router.match(message) != "time":
+        return None
+    _, reply = router.route(message, {})
+    log.info(f"Testudo: {reply}")
+    return reply
+
+
+def _quick_payload(message: str, model: str) -> Dict[str, Any]:
+    return {
         "model": model,
         "messages": [
-            {"role": "system", "content": "You are Testudo, an ai enabled pet like companion. Designed as an turtle. Reply in 1–2 short natural sentences. Avoid emoticons or roleplay stage directions. Don't call people 'friend', 'creator', or other names unless you know their actual name from the conversation. Never use asterisks for actions or movements."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": message}
         ],
         "temperature": 0.7
     }
 
+
+def _quick_pool(lm_studio_url: Union[str, List[str]], http: Optional[HttpClient]) -> LLMPool:
+    """The shared pool for lm_studio_url, or a throwaway one on a caller's client"""
+    if http is None:
+        return default_llm_pool(lm_studio_url)
+    return LLMPool(lm_studio_url, http, probe_interval=0)
+
+
+def _clean_reply(reply: str) -> str:
+    reply = re.sub(r'\*[^*]*\*', '', reply)
+    return re.sub(r'\s+', ' ', reply).strip()
+
+
+def quick_chat(message: str, model: str = "emotion-llama",
+               lm_studio_url: Union[str, List[str]] = LM_STUDIO_URL,
+               http: Optional[HttpClient] = None,
+               cache: Optional[ResponseCache] = None,
+               use_cache: bool = True,
+               pool: Optional[LLMPool] = None) -> str:
+    """Quick chat without history"""
+    time_reply = _quick_time_reply(message)
+    if time_reply:
+        return time_reply
+    
+    pool = pool or _quick_pool(lm_studio_url, http)
+    cache = cache or default_response_cache()
+    payload = _quick_payload(message, model)
+    if use_cache:
+        found, reply = cache.lookup(payload)
+        if found:
+            return reply
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        reply = response.json()["choices"][0]["message"]["content"]
-        
+        status, data = pool.post_json("/v1/chat/completions", payload)
+        reply = _clean_reply(data["choices"][0]["message"]["content"])
+        log.info(f"Testudo: {reply}")
+        if use_cache:
+            cache.store(payload, reply)
+        return reply
+    except Exception as e:
+        log.error(f"Error: {e}")
+        return ""
 
-        reply = re.sub(r'\*[^*]*\*', '', reply)
-        reply = re.sub(r'\s+', ' ', reply).strip()
-        
-        print(f"Testudo: {reply}")
+
+async def quick_chat_async(message: str, model: str = "emotion-llama",
+                           lm_studio_url: Union[str, List[str]] = LM_STUDIO_URL,
+                           http: Optional[HttpClient] = None,
+                           cache: Optional[ResponseCache] = None,
+                           use_cache: bool = True,
+                           pool: Optional[LLMPool] = None) -> str:
+    """quick_chat on the shared asyncio session"""
+    time_reply = _quick_time_reply(message)
+    if time_reply:
+        return time_reply
+    
+    pool = pool or _quick_pool(lm_studio_url, http)
+    cache = cache or default_response_cache()
+    payload = _quick_payload(message, model)
+    if use_cache:
+        found, reply = cache.lookup(payload)
+        if found:
+            return reply
+    try:
+        status, data = await pool.post_json_async("/v1/chat/completions", payload)
+        reply = _clean_reply(data["choices"][0]["message"]["content"])
+        log.info(f"Testudo: {reply}")
+        if use_cache:
+            cache.store(payload, reply)
         return reply
     except Exception as e:
-        print(f"Error: {e}")
+        log.error(f"Error: {e}")
         return ""
 
-async def chat_with_voice(message: str, model: str = "emotion-llama") -> str:
+async def chat_with_voice(message: str, model: str = "emotion-llama",
+                          voice: str = "en-US-JennyNeural") -> str:
     """Chat and generate voice response"""
-    reply = quick_chat(message, model)
+    reply = await quick_chat_async(message, model)
     if reply:
-        communicate = edge_tts.Communicate(reply, voice="en-US-JennyNeural")
-        await communicate.save("response.wav")
-        print(" Audio saved: response.wav")
+        cache = default_audio_cache()
+        path = cache.get(voice, reply)
+        if not path:
+            tmp_path = cache.temp_path()
+            communicate = edge_tts.Communicate(reply, voice=voice)
+            await communicate.save(tmp_path)
+            path = cache.put_file(voice, reply, tmp_path)
+        log.info(f"Audio saved: {path}")
     return reply
 
 
 async def talk_to_testudo(user_message: str, 
                          enable_voice: bool = True,
                          remember_context: bool = True,
-                         auto_search: bool = True) -> Optional[str]:
+                         auto_search: bool = True,
+                         lm_studio_url: Union[str, List[str]] = LM_STUDIO_URL) -> Optional[str]:
     """Main function to chat with Testudo with optional web search"""
     
 
-    testudo = TestudoAI()
+    testudo = TestudoAI(lm_studio_url=lm_studio_url)
     
 
-    if not testudo.check_connection():
-        print("Start LM Studio first!")
-        return None
-    
+    try:
+        if not await testudo.check_connection_async():
+            log.warning("Start LM Studio first!")
+            return None
+        
 
-    start_time = time.time()
-    response = await testudo.chat(user_message, with_voice=enable_voice, auto_search=auto_search)
-    elapsed = time.time() - start_time
-    
-    print(f"Took {elapsed:.2f} seconds")
-    return response
+        start_time = time.time()
+        response = await testudo.chat(user_message, with_voice=enable_voice, auto_search=auto_search)
+        elapsed = time.time() - start_time
+        
+        log.info(f"Took {elapsed:.2f} seconds", extra={"seconds": round(elapsed, 3)})
+        return response
+    finally:
+        await testudo.aclose()
 
 async def test_personal_data():
     """Quick test of personal data functionality"""
@@ -539,8 +3932,10 @@ async def test_personal_data():
     testudo.show_user_data()
     
 
-    if os.path.exists("test_user_data.json"):
-        os.remove("test_user_data.json")
+    testudo.user_store.close()
+    for path in ("test_user_data.db", "test_user_data.db-wal", "test_user_data.db-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
 
 async def main():
@@ -557,14 +3952,26 @@ async def main():
     testudo = TestudoAI()
 
     print("\n=== Example 3: Using Personal Data ===")
-    if testudo.check_connection():
+    if await testudo.check_connection_async():
         await testudo.chat("What's my name?", with_voice=False)
         await testudo.chat("How old am I?", with_voice=False)
         await testudo.chat("Where do I live?", with_voice=False)
         await testudo.chat("What's my job?", with_voice=False)
+    await testudo.aclose()
     
     
 
 if __name__ == "__main__":
+    configure_logging()
+
+    if os.environ.get("TESTUDO_METRICS_FILE"):
+        atexit.register(METRICS.dump, os.environ["TESTUDO_METRICS_FILE"])
 
-    asyncio.run(main())
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        asyncio.run(serve(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000))
+    elif len(sys.argv) > 2 and sys.argv[1] == "batch":
+        asyncio.run(render_batch(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "prerendered"))
+    elif len(sys.argv) > 2 and sys.argv[1] == "index":
+        LocalIndex(sys.argv[3] if len(sys.argv) > 3 else "knowledge_index", source=sys.argv[2]).close()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,138 @@
+"""Pre-rendering a prompt file: the old serial loop vs BatchRender
+
+Replies come from the fake LM Studio in bench_pipeline; speech from a
+stub TTS that returns real 24 kHz WAV audio, so the device transcode is
+included. The serial run asks, speaks and transcodes one line at a time
+like the old chat_with_voice loop. The batch run is repeated on the same
+output folder to show that a finished (or interrupted) batch resumes.
+
+Run from the repo root:  python benchmarks/bench_batch.py [--lines 60]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai
+from ai import (TestudoAI, BatchRender, AudioCache, ResponseCache, UserStore, load_batch,
+                encode_wav16, to_device_wav, configure_logging)
+from bench_pipeline import FakeLMStudio, FakeSearch, StandIns, PROMPTS
+
+
+class WavTTS:
+    """Stands in for edge_tts: a tone as 16-bit WAV, 15 characters per second of speech"""
+
+    rate = 24000
+    first_chunk = 0.05
+    realtime = 20
+    chars_per_second = 15
+
+    class Communicate:
+        def __init__(self, text: str, voice: str = None):
+            self.text = text
+
+        async def stream(self):
+            seconds = len(self.text) / WavTTS.chars_per_second
+            t = np.arange(int(seconds * WavTTS.rate)) / WavTTS.rate
+            wav = encode_wav16(0.3 * np.sin(2 * np.pi * 220 * t), WavTTS.rate)
+            await asyncio.sleep(WavTTS.first_chunk + seconds / WavTTS.realtime)
+            yield {"type": "audio", "data": wav}
+
+        async def save(self, path: str):
+            with open(path, 'wb') as f:
+                async for chunk in self.stream():
+                    f.write(chunk["data"])
+
+
+def write_batch(path: str, lines: int):
+    with open(path, 'w', encoding='utf-8') as f:
+        for n in range(lines):
+            if n % 4 == 3:
+                item = {"id": f"fixed-{n}", "text": f"Reminder number {n}: time to drink some water!"}
+            else:
+                item = {"id": f"line-{n}", "prompt": f"{PROMPTS[n % len(PROMPTS)]} (variant {n})"}
+            f.write(json.dumps(item) + "\n")
+
+
+def testudo(stand_ins: StandIns, workdir: str) -> TestudoAI:
+    return TestudoAI(lm_studio_url=stand_ins.lm_url, user_store=UserStore(":memory:"), web_search=False,
+                     response_cache=ResponseCache(), cache_replies=False,
+                     audio_cache=AudioCache(os.path.join(workdir, "tts_cache")))
+
+
+async def serial(stand_ins: StandIns, items: list, workdir: str) -> int:
+    bot = testudo(stand_ins, workdir)
+    made = 0
+    for n, item in enumerate(items):
+        text = item.get("text") or await bot.ask_ai_async(item["prompt"], keep_history=False, auto_search=False)
+        path = await bot.speak(text)
+        with open(path, 'rb') as f:
+            wav = to_device_wav(f.read())
+        with open(os.path.join(workdir, f"{n}.wav"), 'wb') as f:
+            f.write(wav)
+        made += 1
+    await bot.aclose()
+    return made
+
+
+async def batch(stand_ins: StandIns, items: list, workdir: str, concurrency: int) -> dict:
+    bot = testudo(stand_ins, workdir)
+    try:
+        return dict(await BatchRender(bot, workdir, concurrency, concurrency).run(items))
+    finally:
+        await bot.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=4, help="LLM and TTS workers each")
+    parser.add_argument("--port", type=int, default=8810)
+    args = parser.parse_args()
+
+    configure_logging("WARNING")
+    ai.edge_tts = WavTTS
+    lm = FakeLMStudio(first_token=0.1, token_latency=0.005)
+    workdir = tempfile.mkdtemp(prefix="testudo-batch-")
+    try:
+        source = os.path.join(workdir, "lines.jsonl")
+        write_batch(source, args.lines)
+        items = load_batch(source)
+        with StandIns(lm, FakeSearch(), port=args.port) as stand_ins:
+            start = time.perf_counter()
+            made = asyncio.run(serial(stand_ins, items, os.path.join(workdir, "serial")))
+            serial_seconds = time.perf_counter() - start
+            print(f"serial loop        {serial_seconds:6.2f}s  {made / serial_seconds:6.2f} lines/s")
+
+            out = os.path.join(workdir, "batch")
+            stats = asyncio.run(batch(stand_ins, items, out, args.concurrency))
+            print(f"BatchRender x{args.concurrency}     {stats['seconds']:6.2f}s  "
+                  f"{stats['rendered'] / stats['seconds']:6.2f} lines/s  "
+                  f"({serial_seconds / stats['seconds']:.1f}x, {stats['audio_seconds']:.0f}s of audio)")
+
+            manifest = os.path.join(out, BatchRender.MANIFEST)
+            with open(manifest, encoding='utf-8') as f:
+                entries = f.readlines()
+            with open(manifest, 'w', encoding='utf-8') as f:
+                f.writelines(entries[:len(entries) // 2])
+                f.write(entries[len(entries) // 2][:20])  # a line cut short mid-write
+            stats = asyncio.run(batch(stand_ins, items, out, args.concurrency))
+            print(f"resume, half done  {stats['seconds']:6.2f}s  {stats['rendered']} rendered, "
+                  f"{stats['skipped']} skipped")
+            stats = asyncio.run(batch(stand_ins, items, out, args.concurrency))
+            print(f"rerun, all done    {stats['seconds']:6.2f}s  {stats['rendered']} rendered, "
+                  f"{stats['skipped']} skipped")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
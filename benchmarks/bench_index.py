@@ -0,0 +1,81 @@
+"""LocalIndex build, incremental rebuild, load and query times on a synthetic note folder
+
+Run from the repo root:  python benchmarks/bench_index.py [--notes 2000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai import LocalIndex
+
+WORDS = ("turtle shell ocean reef river mountain volcano robot servo sensor battery planet moon star "
+         "forest desert island city bridge tower river lake glacier museum library school garden "
+         "engine rocket satellite telescope dinosaur fossil crystal magnet circuit wheel").split()
+
+
+def write_notes(folder: str, count: int, rng: random.Random):
+    for n in range(count):
+        sentences = []
+        for s in range(rng.randint(6, 20)):
+            words = rng.choices(WORDS, k=rng.randint(6, 14)) + [f"fact{n}x{s}"]
+            sentences.append(" ".join(words).capitalize() + ".")
+        paragraphs = [" ".join(sentences[i:i + 4]) for i in range(0, len(sentences), 4)]
+        with open(os.path.join(folder, f"note{n:05d}.md"), 'w', encoding='utf-8') as f:
+            f.write(f"# Note {n}\n\n" + "\n\n".join(paragraphs) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    workdir = tempfile.mkdtemp(prefix="testudo-index-")
+    notes, index_dir = os.path.join(workdir, "notes"), os.path.join(workdir, "index")
+    os.makedirs(notes)
+    try:
+        write_notes(notes, args.notes, rng)
+
+        start = time.perf_counter()
+        index = LocalIndex(index_dir, source=notes)
+        full = time.perf_counter() - start
+
+        os.utime(os.path.join(notes, "note00000.md"))
+        start = time.perf_counter()
+        index.build(notes)
+        incremental = time.perf_counter() - start
+        index.close()
+
+        start = time.perf_counter()
+        index = LocalIndex(index_dir)
+        load = time.perf_counter() - start
+
+        latencies, hits = [], 0
+        for _ in range(args.queries):
+            n, s = rng.randrange(args.notes), rng.randrange(6)
+            query = f"what about the {' '.join(rng.sample(WORDS, 2))} fact{n}x{s}"
+            start = time.perf_counter()
+            hits += index.search(query) is not None
+            latencies.append(time.perf_counter() - start)
+        index.close()
+
+        size = sum(os.path.getsize(os.path.join(index_dir, name)) for name in os.listdir(index_dir))
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f"{args.notes} notes, {index.count} passages, {len(index.terms)} terms, index {size / 2 ** 20:.1f} MB")
+        print(f"full build {full * 1000:.0f} ms, one changed note {incremental * 1000:.0f} ms, load {load * 1000:.1f} ms")
+        print(f"search p50 {p50:.2f} ms, p99 {p99:.2f} ms, {hits}/{args.queries} confident hits")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
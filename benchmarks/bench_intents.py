@@ -0,0 +1,123 @@
+"""LLM round trips saved by the IntentRouter on a chat transcript
+
+Replays the profile and clock questions from ai.main() mixed with
+ordinary chat through TestudoAI.ask_ai against the fake LM Studio from
+bench_pipeline, once with only the old time shortcut and once with the
+full router, and times IntentRouter.route itself.
+
+Run from the repo root:  python benchmarks/bench_intents.py [--turns 80]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai import TestudoAI, IntentRouter, PROFILE_INTENTS, ModelCache, AudioCache, configure_logging
+from bench_pipeline import FakeLMStudio, FakeSearch, StandIns
+
+TRANSCRIPT = [
+    "My name is Ed!",
+    "I'm 28 years old",
+    "I live in Zurich",
+    "I work as an engineer",
+    "What's my name?",
+    "How old am I?",
+    "Where do I live?",
+    "What's my job?",
+    "What time is it?",
+    "Tell me something fun about turtles.",
+    "Can you sing me a short song?",
+    "Do you remember my name?",
+    "What do you like to eat?",
+    "What's the date today?",
+]
+
+# Questions that only contain a profile cue; the LLM has to answer these
+NOT_LOCAL = [
+    "Who am I talking to?",
+    "How old am I going to be in 2030?",
+    "What is my work schedule today?",
+    "Where do I live if I move to Paris?",
+    "What day is it tomorrow?",
+    "What's on today?",
+]
+
+# Clock questions without "time" or "date" as a keyword phrase
+CLOCK = [
+    "What day is it today?",
+    "What is today's date?",
+    "What year is it?",
+    "what day of the week is it",
+]
+
+
+def replay(stand_ins: StandIns, workdir: str, router: IntentRouter, turns: int) -> tuple:
+    """(wall seconds, replies) for `turns` messages of the transcript"""
+    testudo = TestudoAI(lm_studio_url=stand_ins.lm_url, web_search=False, cache_replies=False,
+                        user_data_file=os.path.join(workdir, f"{id(router)}.json"),
+                        model_cache=ModelCache(path=None), intent_router=router,
+                        audio_cache=AudioCache(os.path.join(workdir, "tts_cache")))
+    start = time.perf_counter()
+    replies = [testudo.ask_ai(TRANSCRIPT[n % len(TRANSCRIPT)], auto_search=False) for n in range(turns)]
+    seconds = time.perf_counter() - start
+    testudo.http.close()
+    testudo.user_store.close()
+    return seconds, replies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=48)
+    parser.add_argument("--port", type=int, default=8820)
+    args = parser.parse_args()
+
+    configure_logging("WARNING")
+    time_only = IntentRouter()
+    for name in PROFILE_INTENTS:
+        time_only.remove(name)
+    full = IntentRouter()
+
+    lm = FakeLMStudio(first_token=0.1, token_latency=0.003)
+    workdir = tempfile.mkdtemp(prefix="testudo-intents-")
+    try:
+        with StandIns(lm, FakeSearch(), port=args.port) as stand_ins:
+            for label, router in (("time shortcut only", time_only), ("intent router", full)):
+                before = lm.requests
+                seconds, replies = replay(stand_ins, workdir, router, args.turns)
+                stats = router.stats()
+                print(f"{label:<20} {lm.requests - before:3d} LLM calls, {stats['deflected']:3d} answered locally "
+                      f"({stats['deflection_rate']:.0%}), {seconds:5.2f}s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print("sample replies:", *replies[4:9], sep="\n  ")
+
+    profile = {"name": "Ed", "age": 28, "location": "Zurich", "occupation": "Engineer"}
+    start = time.perf_counter()
+    rounds = 2000
+    for _ in range(rounds):
+        for message in TRANSCRIPT:
+            full.route(message, profile)
+    per_call = (time.perf_counter() - start) / (rounds * len(TRANSCRIPT)) * 1e6
+    print(f"IntentRouter.route: {per_call:.1f} us per message")
+
+    wrong = [(message, full.route(message, profile)) for message in NOT_LOCAL]
+    wrong = [(message, routed) for message, routed in wrong if routed]
+    for message, (intent, reply) in wrong:
+        print(f"answered locally by mistake: {message!r} -> {intent}: {reply!r}")
+    for message in CLOCK:
+        if full.match(message) != "time":
+            wrong.append((message, "not a clock question"))
+            print(f"clock question not answered locally: {message!r}")
+    if full.route("What's my job?", {"occupation": ""}) != ("occupation", PROFILE_INTENTS["occupation"][2]):
+        wrong.append(("What's my job?", "empty occupation"))
+        print("an empty occupation was not treated as unknown")
+    if wrong:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Completion latency over one LM Studio box vs an LLMPool, with and without hedging
+
+Two fake LM Studio servers answer in ~0.2 s but stall for a couple of
+seconds on a fraction of requests (a busy GPU, a swap, a GC pause); a
+third endpoint is dead. quick_chat_async is driven at a fixed concurrency
+through a single endpoint, a pool of all three, and the same pool with
+hedge_after set, and reports latency percentiles and failures.
+
+Run from the repo root:  python benchmarks/bench_llm_pool.py [--requests 200]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai import LLMPool, HttpClient, quick_chat_async, configure_logging
+from bench_pipeline import FakeLMStudio, FakeSearch, StandIns, PROMPTS
+
+
+class StallingLMStudio(FakeLMStudio):
+    """FakeLMStudio that sometimes sits on a request for `stall` seconds"""
+
+    def __init__(self, stall_rate: float, stall: float, seed: int, **options):
+        super().__init__(**options)
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.rng = random.Random(seed)
+
+    async def completions(self, request):
+        await request.read()  # before stalling, so a hedged-away client can hang up quietly
+        if self.rng.random() < self.stall_rate:
+            await asyncio.sleep(self.stall)
+        return await super().completions(request)
+
+
+async def drive(pool: LLMPool, requests: int, concurrency: int) -> tuple:
+    """(latencies, failures) for `requests` quick_chat_async calls"""
+    latencies, failures = [], 0
+    queue = list(range(requests))
+
+    async def user():
+        nonlocal failures
+        while queue:
+            i = queue.pop()
+            start = time.perf_counter()
+            reply = await quick_chat_async(f"{PROMPTS[i % len(PROMPTS)]} #{i}", use_cache=False, pool=pool)
+            latencies.append(time.perf_counter() - start)
+            failures += not reply
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    await pool.aclose()
+    await pool.http.aclose()
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stall-rate", type=float, default=0.05)
+    parser.add_argument("--stall", type=float, default=2.0)
+    parser.add_argument("--hedge-after", type=float, default=0.5)
+    parser.add_argument("--port", type=int, default=8800)
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+    boxes = [StallingLMStudio(args.stall_rate, args.stall, seed, first_token=0.1, token_latency=0.003)
+             for seed in range(2)]
+    stand_ins = [StandIns(lm, FakeSearch(), port=args.port + 2 * n) for n, lm in enumerate(boxes)]
+    dead = f"http://127.0.0.1:{args.port + 2 * len(boxes)}"
+    for s in stand_ins:
+        s.__enter__()
+    try:
+        urls = [s.lm_url for s in stand_ins] + [dead]
+        setups = {"one endpoint": dict(urls=urls[:1]),
+                  "pool of 3": dict(urls=urls),
+                  f"pool, hedge {args.hedge_after}s": dict(urls=urls, hedge_after=args.hedge_after)}
+        print(f"{'setup':<20} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7} {'req/s':>7} {'failed':>7}  requests per box")
+        for name, options in setups.items():
+            before = [lm.requests for lm in boxes]
+            pool = LLMPool(http=HttpClient(pool_size=32, per_host=16), **options)
+            start = time.perf_counter()
+            latencies, failures = asyncio.run(drive(pool, args.requests, args.concurrency))
+            elapsed = time.perf_counter() - start
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            per_box = [lm.requests - b for lm, b in zip(boxes, before)]
+            print(f"{name:<20} {p50:6.2f}s {p95:6.2f}s {p99:6.2f}s {max(latencies):6.2f}s "
+                  f"{args.requests / elapsed:7.1f} {failures:7d}  {per_box}")
+    finally:
+        for s in stand_ins:
+            s.__exit__(None, None, None)
+
+
+if __name__ == "__main__":
+    main()
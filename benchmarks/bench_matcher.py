@@ -0,0 +1,123 @@
+"""Micro-benchmark: single pass MessageMatcher vs the old per-pattern re.search path
+
+Run from the repo root:  python benchmarks/bench_matcher.py
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai import MessageMatcher, TIME_KEYWORDS, UNKNOWN_PHRASES, W_WORDS
+
+
+MESSAGES = [
+    "My name is Alice and I'm 28 years old",
+    "I live in New York and work as a designer",
+    "Call me Bob, I'm from London",
+    "I am 35 years old and work as a teacher",
+    "I'm a 22 year old student",
+    "What time is it?",
+    "Who wrote the odyssey?",
+    "I'm tired today",
+    "Tell me something nice about turtles",
+    "I don't know what to eat for dinner, any ideas?",
+    "My job is nurse at the city hospital",
+    "What's the date today in Istanbul",
+    "I am in Zurich for the week",
+    "Can you sing me a song about the sea and the sand and the sun",
+]
+
+
+def legacy_extract(message):
+    """extract_personal_info as it was before the single pass matcher"""
+    extracted = {}
+    message_lower = message.lower().strip()
+    for pattern in [r"my name is ([a-zA-Z\s]+)", r"i'm ([a-zA-Z\s]+)", r"i am ([a-zA-Z\s]+)",
+                    r"call me ([a-zA-Z\s]+)", r"i'm called ([a-zA-Z\s]+)"]:
+        match = re.search(pattern, message_lower)
+        if match:
+            name = match.group(1).strip().title()
+            common_words = ['happy', 'sad', 'tired', 'good', 'fine', 'okay', 'great', 'studying', 'working', 'here', 'back', 'done']
+            if name.lower() not in common_words and len(name) > 1:
+                extracted['name'] = name
+                break
+    for pattern in [r"i am (\d+) years old", r"i'm (\d+) years old", r"i am (\d+)", r"i'm (\d+)", r"(\d+) years old"]:
+        match = re.search(pattern, message_lower)
+        if match:
+            age = int(match.group(1))
+            if 1 <= age <= 120:
+                extracted['age'] = age
+                break
+    for pattern in [r"i live in ([a-zA-Z\s]+)", r"i'm from ([a-zA-Z\s]+)", r"i am from ([a-zA-Z\s]+)",
+                    r"i'm in ([a-zA-Z\s]+)", r"i am in ([a-zA-Z\s]+)"]:
+        match = re.search(pattern, message_lower)
+        if match:
+            location = match.group(1).strip().title()
+            if len(location) > 1:
+                extracted['location'] = location
+                break
+    for pattern in [r"i work as a ([a-zA-Z\s]+)", r"i work as an ([a-zA-Z\s]+)", r"i am a ([a-zA-Z\s]+)",
+                    r"i'm a ([a-zA-Z\s]+)", r"my job is ([a-zA-Z\s]+)"]:
+        match = re.search(pattern, message_lower)
+        if match:
+            job = match.group(1).strip().title()
+            job_words = ['student', 'teacher', 'doctor', 'engineer', 'programmer', 'developer', 'designer', 'writer', 'artist', 'lawyer', 'nurse', 'manager']
+            if any(word in job.lower() for word in job_words) or len(job.split()) <= 3:
+                extracted['occupation'] = job
+                break
+    return extracted
+
+
+def legacy_path(message):
+    """Everything ask_ai used to run on one prompt and its reply"""
+    legacy_extract(message)
+    lower = message.lower()
+    any(keyword in lower for keyword in TIME_KEYWORDS)
+    question_lower = lower.strip()
+    any(question_lower.startswith(w_word) for w_word in W_WORDS)
+    any(phrase in lower for phrase in UNKNOWN_PHRASES)
+
+
+def timed(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return time.perf_counter() - start
+
+
+def main(rounds: int = 2000):
+    uncached = MessageMatcher(cache_size=0)
+    cached = MessageMatcher()
+
+    def old():
+        for message in MESSAGES:
+            legacy_path(message)
+
+    def new():
+        for message in MESSAGES:
+            uncached.match(message)
+
+    def batch():
+        cached.extract_batch(MESSAGES)
+
+    count = rounds * len(MESSAGES)
+    results = [("legacy re.search path", timed(old, rounds)),
+               ("single pass matcher", timed(new, rounds)),
+               ("extract_batch (cached)", timed(batch, rounds))]
+
+    baseline = results[0][1]
+    print(f"{count} messages per run")
+    for label, elapsed in results:
+        print(f"{label:<26} {elapsed * 1e6 / count:8.2f} us/msg  x{baseline / elapsed:5.1f}")
+
+    print("\nDifferences from the legacy extractor:")
+    for message in MESSAGES:
+        old_info, new_info = legacy_extract(message), uncached.personal_info(message)
+        if old_info != new_info:
+            print(f"  {message!r}\n    legacy: {old_info}\n    now:    {new_info}")
+
+
+if __name__ == "__main__":
+    main()
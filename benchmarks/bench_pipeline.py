@@ -0,0 +1,398 @@
+"""Offline throughput and latency benchmark for the whole chat pipeline
+
+Three stand-ins replace the network:
+  FakeLMStudio  OpenAI-compatible /v1/models and /v1/chat/completions, blocking
+                and SSE streaming, with a per-token delay
+  StubTTS       drop-in for the edge_tts module, MP3-sized chunks at a fixed rate
+  FakeSearch    canned Google results page
+
+Each scenario drives ask_ai, chat or quick_chat at concurrency 1 and N and
+reports throughput, p50/p95/p99 latency and memory. Results can be saved as
+a baseline and compared against a later run.
+
+Run from the repo root:
+    python benchmarks/bench_pipeline.py --save
+    python benchmarks/bench_pipeline.py --compare benchmarks/baselines/<commit>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai
+from ai import (TestudoAI, HttpClient, SearchCache, ResponseCache, AudioCache, ConversationMemory,
+                quick_chat, quick_chat_async, configure_logging, METRICS)
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+PROMPTS = [
+    "Hello Testudo, how are you today?",
+    "Tell me something fun about turtles.",
+    "What is the tallest mountain in Europe?",
+    "My name is Alice and I'm 28 years old",
+    "What time is it?",
+    "Can you sing me a short song?",
+    "Who wrote the Odyssey?",
+    "I live in Zurich and work as an engineer",
+]
+
+REPLY = ("Oh, what a lovely question! Turtles like me have been around for more than two hundred "
+         "million years. *wiggles flippers* I love slow walks and warm rocks. What else would you like to know?")
+
+SEARCH_PAGE = ("<html><body><div>Search</div>"
+               "<span class=\"BNeawe s3v9rd AP7Wnd\">Mount Elbrus is the highest mountain in Europe at 5,642 metres.</span>"
+               "<span class=\"BNeawe s3v9rd AP7Wnd\">More results</span>"
+               + "<div class=\"g\">filler result text</div>" * 200 +
+               "</body></html>")
+
+
+class FakeLMStudio:
+    """OpenAI chat API with LM Studio's shape and a configurable token rate"""
+
+    def __init__(self, first_token: float = 0.05, token_latency: float = 0.005, reply: str = REPLY):
+        self.first_token = first_token
+        self.token_latency = token_latency
+        self.tokens = [word + " " for word in reply.split()]
+        self.requests = 0
+        self.model_requests = 0
+        self.app = web.Application()
+        self.app.router.add_get("/v1/models", self.models)
+        self.app.router.add_post("/v1/chat/completions", self.completions)
+
+    async def models(self, request):
+        self.model_requests += 1
+        return web.json_response({"object": "list", "data": [{"id": "emotion-llama", "object": "model"}]})
+
+    async def completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        # A distinct first sentence per request, so TTS can't answer from its cache
+        tokens = [f"Reply {self.requests}. "] + self.tokens
+        await asyncio.sleep(self.first_token)
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_latency * len(tokens))
+            return web.json_response({"choices": [{"index": 0, "message": {"role": "assistant",
+                                                                           "content": "".join(tokens)}}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in tokens:
+            chunk = {"choices": [{"index": 0, "delta": {"content": token}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.token_latency)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+class FakeSearch:
+    """Serves the same canned results page for every query"""
+
+    def __init__(self, latency: float = 0.05, page: str = SEARCH_PAGE):
+        self.latency = latency
+        self.page = page
+        self.requests = 0
+        self.app = web.Application()
+        self.app.router.add_get("/search", self.search)
+
+    async def search(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return web.Response(text=self.page, content_type="text/html")
+
+
+class StubTTS:
+    """Stands in for the edge_tts module: 6 KB of 'MP3' per second of speech"""
+
+    first_chunk = 0.03
+    chars_per_second = 15
+    bytes_per_second = 6000
+    chunk_bytes = 1440
+    realtime = 20
+
+    class Communicate:
+        def __init__(self, text: str, voice: str = None):
+            self.text = text
+            self.voice = voice
+
+        async def stream(self):
+            size = int(len(self.text) / StubTTS.chars_per_second * StubTTS.bytes_per_second)
+            await asyncio.sleep(StubTTS.first_chunk)
+            for offset in range(0, size, StubTTS.chunk_bytes):
+                data = b"\xff\xfb" + b"\0" * (min(StubTTS.chunk_bytes, size - offset) - 2)
+                await asyncio.sleep(len(data) / StubTTS.bytes_per_second / StubTTS.realtime)
+                yield {"type": "audio", "data": data}
+
+        async def save(self, path: str):
+            with open(path, 'wb') as f:
+                async for chunk in self.stream():
+                    f.write(chunk["data"])
+
+
+class StandIns:
+    """Runs the fake servers on their own event loop thread"""
+
+    def __init__(self, lm: FakeLMStudio, search: FakeSearch, host: str = "127.0.0.1", port: int = 8790):
+        self.lm = lm
+        self.search = search
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.runners = []
+
+    @property
+    def lm_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def search_url(self) -> str:
+        return f"http://{self.host}:{self.port + 1}/search"
+
+    async def _start(self):
+        for app, port in ((self.lm.app, self.port), (self.search.app, self.port + 1)):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, self.host, port).start()
+            self.runners.append(runner)
+
+    async def _stop(self):
+        for runner in self.runners:
+            await runner.cleanup()
+
+    def __enter__(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class Bench:
+    """Builds TestudoAI instances against the stand-ins and times scenarios"""
+
+    def __init__(self, stand_ins: StandIns, workdir: str, cached: bool = False, trace_memory: bool = False):
+        self.stand_ins = stand_ins
+        self.workdir = workdir
+        self.cached = cached
+        self.trace_memory = trace_memory
+        self.http = HttpClient(pool_size=64, per_host=64)
+
+    def testudo(self, user: int, **options) -> TestudoAI:
+        return TestudoAI(lm_studio_url=self.stand_ins.lm_url,
+                         search_url=self.stand_ins.search_url,
+                         user_data_file=os.path.join(self.workdir, "user_data.json"),
+                         user_id=f"bench-{user}",
+                         http=self.http,
+                         search_cache=SearchCache(path=None),
+                         response_cache=ResponseCache(),
+                         cache_replies=self.cached,
+                         memory=ConversationMemory(),
+                         audio_cache=AudioCache(os.path.join(self.workdir, "tts_cache")),
+                         **options)
+
+    @staticmethod
+    def prompt(i: int) -> str:
+        return PROMPTS[i % len(PROMPTS)]
+
+    def _timed_sync(self, call, requests: int, concurrency: int) -> list:
+        def one(i):
+            start = time.perf_counter()
+            ok = bool(call(i))
+            return time.perf_counter() - start, ok
+        with ThreadPoolExecutor(concurrency) as pool:
+            return list(pool.map(one, range(requests)))
+
+    async def _timed_async(self, call, requests: int, concurrency: int) -> list:
+        results = []
+
+        async def user(u):
+            for i in range(u, requests, concurrency):
+                start = time.perf_counter()
+                ok = bool(await call(u, i))
+                results.append((time.perf_counter() - start, ok))
+        await asyncio.gather(*(user(u) for u in range(concurrency)))
+        return results
+
+    def ask_ai(self, requests: int, concurrency: int) -> list:
+        users = [self.testudo(u) for u in range(concurrency)]
+        try:
+            return self._timed_sync(lambda i: users[i % concurrency].ask_ai(self.prompt(i)), requests, concurrency)
+        finally:
+            for testudo in users:
+                asyncio.run(testudo.aclose())
+
+    def chat(self, requests: int, concurrency: int, with_voice: bool = False, stream: bool = False) -> list:
+        async def run():
+            users = [self.testudo(u) for u in range(concurrency)]
+            try:
+                return await self._timed_async(
+                    lambda u, i: users[u].chat(self.prompt(i), with_voice=with_voice, stream=stream),
+                    requests, concurrency)
+            finally:
+                for testudo in users:
+                    await testudo.aclose()
+                await self.http.aclose()
+        return asyncio.run(run())
+
+    def quick_chat(self, requests: int, concurrency: int) -> list:
+        cache = ResponseCache()
+        return self._timed_sync(lambda i: quick_chat(self.prompt(i), lm_studio_url=self.stand_ins.lm_url,
+                                                     http=self.http, cache=cache, use_cache=self.cached),
+                                requests, concurrency)
+
+    def quick_chat_async(self, requests: int, concurrency: int) -> list:
+        async def run():
+            cache = ResponseCache()
+            try:
+                return await self._timed_async(
+                    lambda u, i: quick_chat_async(self.prompt(i), lm_studio_url=self.stand_ins.lm_url,
+                                                  http=self.http, cache=cache, use_cache=self.cached),
+                    requests, concurrency)
+            finally:
+                await self.http.aclose()
+        return asyncio.run(run())
+
+    def measure(self, name: str, scenario, requests: int, concurrency: int) -> dict:
+        """Run one scenario and summarize it"""
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        results = scenario(requests, concurrency)
+        elapsed = time.perf_counter() - start
+        heap_peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        if self.trace_memory:
+            tracemalloc.stop()
+
+        latencies = np.array([seconds for seconds, _ in results])
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary = {"requests": requests,
+                   "concurrency": concurrency,
+                   "errors": sum(1 for _, ok in results if not ok),
+                   "seconds": round(elapsed, 4),
+                   "throughput": round(requests / elapsed, 2),
+                   "p50_ms": round(p50 * 1000, 2),
+                   "p95_ms": round(p95 * 1000, 2),
+                   "p99_ms": round(p99 * 1000, 2),
+                   "max_rss_mb": round(max_rss_mb(), 1)}
+        if heap_peak is not None:
+            summary["heap_peak_mb"] = round(heap_peak / 2 ** 20, 2)
+        print(f"{name:<28} {summary['throughput']:>8.1f} req/s  p50 {summary['p50_ms']:>8.1f}  "
+              f"p95 {summary['p95_ms']:>8.1f}  p99 {summary['p99_ms']:>8.1f} ms  "
+              f"errors {summary['errors']}  rss {summary['max_rss_mb']} MB"
+              + (f"  heap {summary['heap_peak_mb']} MB" if heap_peak is not None else ""))
+        return summary
+
+
+def max_rss_mb() -> float:
+    """Peak resident set size of this process so far"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(current: dict, baseline: dict):
+    """Print throughput and latency change per scenario against a saved run"""
+    print(f"\nvs {baseline.get('commit', '?')} ({baseline.get('date', '?')})")
+    for name, now in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            print(f"{name:<28} (new)")
+            continue
+        changes = []
+        for key in ("throughput", "p50_ms", "p95_ms", "p99_ms"):
+            if before[key]:
+                changes.append(f"{key} {(now[key] - before[key]) / before[key] * 100:+.1f}%")
+        print(f"{name:<28} " + "  ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=64, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="simulated users in the concurrent runs")
+    parser.add_argument("--first-token", type=float, default=0.05, help="fake LM Studio time to first token (s)")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="fake LM Studio delay per token (s)")
+    parser.add_argument("--tts-speed", type=float, default=20, help="stub TTS seconds of speech per wall second")
+    parser.add_argument("--search-latency", type=float, default=0.05, help="fake search server delay (s)")
+    parser.add_argument("--only", nargs="*", help="scenario names to run")
+    parser.add_argument("--cached", action="store_true", help="leave the response caches on")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report Python heap peaks (slower)")
+    parser.add_argument("--save", nargs="?", const="", help="write results as a baseline (default baselines/<commit>.json)")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--port", type=int, default=8790)
+    args = parser.parse_args()
+
+    configure_logging("WARNING")
+    ai.edge_tts = StubTTS
+    StubTTS.realtime = args.tts_speed
+    workdir = tempfile.mkdtemp(prefix="testudo-bench-")
+    lm = FakeLMStudio(first_token=args.first_token, token_latency=args.token_latency)
+    search = FakeSearch(latency=args.search_latency)
+
+    try:
+        with StandIns(lm, search, port=args.port) as stand_ins:
+            bench = Bench(stand_ins, workdir, cached=args.cached, trace_memory=args.tracemalloc)
+            scenarios = {
+                "ask_ai": bench.ask_ai,
+                "chat": bench.chat,
+                "chat_voice": lambda n, c: bench.chat(n, c, with_voice=True),
+                "chat_stream_voice": lambda n, c: bench.chat(n, c, with_voice=True, stream=True),
+                "quick_chat": bench.quick_chat,
+                "quick_chat_async": bench.quick_chat_async,
+            }
+            results = {}
+            for name, scenario in scenarios.items():
+                if args.only and name not in args.only:
+                    continue
+                for concurrency in sorted({1, args.concurrency}):
+                    label = f"{name}@{concurrency}"
+                    results[label] = bench.measure(label, scenario, args.requests, concurrency)
+            bench.http.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    run = {"commit": git_commit(),
+           "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "python": sys.version.split()[0],
+           "config": {k: v for k, v in vars(args).items() if k not in ("save", "compare", "only")},
+           "llm_requests": lm.requests,
+           "search_requests": search.requests,
+           "stages": METRICS.snapshot()["stages"],
+           "scenarios": results}
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(run, json.load(f))
+    if args.save is not None:
+        path = args.save or os.path.join(BASELINE_DIR, f"{run['commit']}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(run, f, indent=2)
+        print(f"\nSaved {path}")
+
+
+if __name__ == "__main__":
+    main()
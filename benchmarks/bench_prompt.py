@@ -0,0 +1,114 @@
+"""Prompt tokens the backend must process per turn, classic vs stable prompt layout
+
+A llama.cpp-style server keeps the KV cache of the previous request (its
+prompt plus the reply) and only processes the new prompt from the first
+token that differs. This replays a scripted conversation through
+TestudoAI.build_messages for each layout, renders the messages with a
+ChatML-like template, and counts re-processed tokens per turn.
+
+Run from the repo root:  python benchmarks/bench_prompt.py [--turns 40]
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai import TestudoAI, AudioCache, ModelCache, configure_logging
+
+QUESTIONS = ["How are you today?", "Tell me a fun fact about turtles.", "What do you like to eat?",
+             "Can you sing me a song?", "Do you like the rain?", "What did you do yesterday?",
+             "Tell me a joke please.", "How fast can you walk?", "Are you sleepy?"]
+
+REPLIES = ["I'm doing great, thanks for asking! My shell feels extra shiny today.",
+           "Turtles have been around for over two hundred million years, even before the dinosaurs.",
+           "I love crunchy lettuce and the occasional strawberry when nobody is looking.",
+           "La la la, a turtle on a walk, la la la, slow and steady never stops!",
+           "Rain is lovely, it makes the garden smell fresh and the puddles fun."]
+
+FACTS = {6: "My name is Alice", 15: "I live in Zurich", 27: "I work as a teacher"}
+
+
+def tokens(text: str) -> list:
+    """Stand-in tokenizer: words and punctuation"""
+    return re.findall(r"\w+|[^\w\s]", text)
+
+
+def render(messages: list) -> list:
+    return tokens("".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+                  + "<|im_start|>assistant\n")
+
+
+def common_prefix(a: list, b: list) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def replay(layout: str, turns: int, workdir: str, seed: int = 0, reply_repeat: int = 1) -> list:
+    """(prompt tokens, tokens the server has to process, history messages) for every turn"""
+    rng = random.Random(seed)
+    testudo = TestudoAI(user_data_file=os.path.join(workdir, f"{layout}.json"), prompt_layout=layout,
+                        model_cache=ModelCache(path=None), web_search=False,
+                        audio_cache=AudioCache(os.path.join(workdir, "tts_cache")))
+    cached: list = []
+    result = []
+    for turn in range(turns):
+        prompt = rng.choice(QUESTIONS)
+        if turn in FACTS:
+            testudo.update_user_data(testudo.extract_personal_info(FACTS[turn]))
+            prompt = FACTS[turn] + ". " + prompt
+        messages = testudo.build_messages(prompt)
+        history = sum(1 for m in messages if m["role"] in ("user", "assistant")) - 1
+        prompt_tokens = render(messages)
+        processed = len(prompt_tokens) - common_prefix(cached, prompt_tokens)
+        reply = " ".join([rng.choice(REPLIES)] * reply_repeat)
+        cached = prompt_tokens + tokens(reply + "<|im_end|>")
+        result.append((len(prompt_tokens), processed, history))
+        testudo._remember(prompt, reply, True)
+    testudo.user_store.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--verbose", action="store_true", help="print every turn")
+    parser.add_argument("--reply-repeat", type=int, default=1,
+                        help="repeat each canned reply, e.g. 8 for ~150-token replies")
+    args = parser.parse_args()
+
+    configure_logging("WARNING")
+    workdir = tempfile.mkdtemp(prefix="testudo-prompt-")
+    try:
+        runs = {layout: replay(layout, args.turns, workdir, reply_repeat=args.reply_repeat)
+                for layout in ("classic", "stable")}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.verbose:
+        print("turn  classic prompt/processed   stable prompt/processed")
+        for turn, (classic, stable) in enumerate(zip(runs["classic"], runs["stable"])):
+            print(f"{turn:4d}  {classic[0]:8d} / {classic[1]:<8d}       {stable[0]:8d} / {stable[1]:<8d}")
+
+    for layout, turns in runs.items():
+        prompt = sum(t[0] for t in turns) / len(turns)
+        processed = sum(t[1] for t in turns) / len(turns)
+        print(f"{layout:<8} prompt {prompt:6.0f} tokens/turn, processed {processed:6.0f} tokens/turn "
+              f"({processed / prompt:.0%} of the prompt), history {min(t[2] for t in turns[1:])}"
+              f"-{max(t[2] for t in turns)} messages")
+    classic = sum(t[1] for t in runs["classic"])
+    stable = sum(t[1] for t in runs["stable"])
+    print(f"stable layout saves {(classic - stable) / args.turns:.0f} prompt tokens per turn "
+          f"({(classic - stable) / classic:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Bytes read and CPU time: streaming SnippetScanner vs the old regex passes
+
+The regex version needs the whole page and scans it up to four times;
+SnippetScanner is fed 8 KiB chunks and stops at the first usable snippet.
+Answers differ where the old code left entities like &nbsp; undecoded.
+Pages are synthetic Google basic-HTML result pages by default; pass
+--pages DIR to use saved real ones (*.html).
+
+Run from the repo root:  python benchmarks/bench_search.py [--pages saved_pages/]
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai import SnippetScanner
+
+CHUNK = 8192
+
+
+def legacy_parse(text: str):
+    """TestudoAI.parse_search_results before the streaming parser, verbatim minus logging"""
+    snippet_patterns = [
+        r'class="BNeawe[^"]*"[^>]*>([^<]+)</span>',
+        r'class="hgKElc"[^>]*>([^<]+)</span>',
+        r'class="st"[^>]*>([^<]+)</span>',
+    ]
+
+    for pattern in snippet_patterns:
+        matches = re.findall(pattern, text)
+        if matches:
+            for match in matches:
+                sentence = match.strip()
+                if len(sentence) > 20 and not any(skip in sentence.lower() for skip in ['search', 'more', 'about', 'sign in', 'images']):
+                    sentence = sentence.replace('&quot;', '"').replace('&amp;', '&').replace('&#39;', "'")
+                    return sentence
+
+    div_pattern = r'<div[^>]*>([^<]+)</div>'
+    div_matches = re.findall(div_pattern, text)
+    for match in div_matches:
+        sentence = match.strip()
+        if len(sentence) > 30 and len(sentence) < 200:
+            if not any(skip in sentence.lower() for skip in ['search', 'more', 'about', 'sign in', 'images', 'videos']):
+                sentence = sentence.replace('&quot;', '"').replace('&amp;', '&').replace('&#39;', "'")
+                return sentence
+    return None
+
+
+def streamed_parse(page: bytes):
+    """(answer, bytes read) feeding the page to SnippetScanner chunk by chunk"""
+    parser = SnippetScanner()
+    read = 0
+    for offset in range(0, len(page), CHUNK):
+        chunk = page[offset:offset + CHUNK]
+        read += len(chunk)
+        if parser.feed(chunk.decode('utf-8', errors='replace')):
+            break
+    return parser.result()[0], read
+
+
+def result_block(i: int, snippet: str, snippet_tag: str = "div") -> str:
+    sitelinks = "".join(f'<div class="BNeawe deIvCb AP7Wnd"><a href="/url?q=https://example{i}.org/{n}">'
+                        f'Link {n}</a></div><div class="BNeawe s3v9rd AP7Wnd"><span>Part {n}</span></div>'
+                        for n in range(20))
+    return (f'<div class="Gx5Zad fP1Qef xpd EtOod pkphOe"><div class="egMi0 kCrYT">'
+            f'<a href="/url?q=https://example{i}.org/page&amp;sa=U&amp;ved=2ahUKE{i:06d}">'
+            f'<h3 class="zBAuLc l97dzf"><div class="BNeawe vvjwJb AP7Wnd">Result {i} title</div></h3>'
+            f'<div class="BNeawe UPmit AP7Wnd lRVwie">example{i}.org &rsaquo; page</div></a></div>'
+            f'<div class="kCrYT"><div><div class="BNeawe s3v9rd AP7Wnd"><div><div>'
+            f'<{snippet_tag} class="BNeawe s3v9rd AP7Wnd">{snippet}</{snippet_tag}>'
+            f'</div></div></div></div></div>{sitelinks}</div>')
+
+
+def synthetic_page(answer_at: float, results: int = 10) -> bytes:
+    """A ~150 KB results page with a span snippet at fraction answer_at (None: only div text)
+
+    Laid out like Google's basic HTML: inline CSS, ten results with
+    sitelinks, then a large inline script and footer.
+    """
+    head = ('<!doctype html><html><head><meta charset="UTF-8"><title>query - Google Search</title>'
+            '<style>' + ".x{margin:0;padding:0}" * 600 + '</style></head><body>'
+            '<div class="n692Zd"><div>All</div><div>Images</div><div>Videos</div><div>News</div></div>')
+    filler = "Lorem ipsum dolor sit amet, consectetur adipiscing elit &amp; sed do eiusmod tempor"
+    blocks = [result_block(i, f"{filler} #{i}") for i in range(results)]
+    if answer_at is not None:
+        answer = "Mount Elbrus is the highest mountain in Europe, at 5,642&nbsp;m (&quot;18,510 ft&quot;)."
+        blocks.insert(int(answer_at * results), result_block(99, answer, snippet_tag="span"))
+    footer = ('<footer>' + '<div class="Srfpq">Sign in to see more</div>' * 50 + '</footer>'
+              '<script>' + "(function(){var a=window.google||{};a.x=1;})();" * 1200 + '</script></body></html>')
+    return (head + "".join(blocks) + footer).encode('utf-8')
+
+
+def cpu_ms(fn, page, repeat: int) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        fn(page)
+    return (time.process_time() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", help="directory of saved result pages (*.html)")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = {}
+        for path in sorted(glob.glob(os.path.join(args.pages, "*.html"))):
+            with open(path, 'rb') as f:
+                pages[os.path.basename(path)] = f.read()
+    else:
+        pages = {"snippet near top": synthetic_page(0.1),
+                 "snippet mid-page": synthetic_page(0.5),
+                 "snippet at end": synthetic_page(1.0),
+                 "no snippet": synthetic_page(None)}
+
+    print(f"{'page':<20} {'size':>8} {'regex read':>11} {'stream read':>12} {'regex cpu':>10} {'stream cpu':>11}")
+    total_legacy = total_stream = 0
+    for name, page in pages.items():
+        legacy_answer = legacy_parse(page.decode('utf-8', errors='replace'))
+        answer, read = streamed_parse(page)
+        legacy_cpu = cpu_ms(lambda p: legacy_parse(p.decode('utf-8', errors='replace')), page, args.repeat)
+        stream_cpu = cpu_ms(streamed_parse, page, args.repeat)
+        total_legacy += legacy_cpu
+        total_stream += stream_cpu
+        print(f"{name:<20} {len(page) / 1024:7.1f}K {len(page) / 1024:10.1f}K {read / 1024:11.1f}K "
+              f"{legacy_cpu:8.2f}ms {stream_cpu:9.2f}ms")
+        if answer != legacy_answer:
+            print(f"    regex:  {legacy_answer!r}\n    stream: {answer!r}")
+    print(f"{'total cpu':<20} {'':>32} {total_legacy:9.2f}ms {total_stream:9.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
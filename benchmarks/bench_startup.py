@@ -0,0 +1,118 @@
+"""Cold-start time of `import ai` and of a one-shot CLI answer
+
+Each measurement is a fresh interpreter. Reports the bare interpreter,
+`import ai` alone (and which heavy modules it dragged in), and
+talk_to_testudo against the fake LM Studio from bench_pipeline, once with
+no model cache and once with the listing cached on disk, which should
+skip the /v1/models round trip.
+
+Run from the repo root:  python benchmarks/bench_startup.py [--max-import-ms 150]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_pipeline import FakeLMStudio, FakeSearch, StandIns
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ("numpy", "requests", "aiohttp", "edge_tts", "miniaudio")
+
+IMPORT_ONLY = """
+import json, sys, time
+start = time.perf_counter()
+import ai
+print(json.dumps({"import_ms": (time.perf_counter() - start) * 1000,
+                  "heavy": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+CLI = """
+import asyncio, json, sys, time
+start = time.perf_counter()
+import ai
+imported = time.perf_counter()
+ai.configure_logging("WARNING")
+reply = asyncio.run(ai.talk_to_testudo("Hello Testudo!", enable_voice=False, auto_search=False,
+                                       lm_studio_url=sys.argv[1]))
+print(json.dumps({"import_ms": (imported - start) * 1000,
+                  "reply_ms": (time.perf_counter() - imported) * 1000,
+                  "ok": bool(reply)}))
+"""
+
+
+def run(code: str, *args, cwd: str = REPO) -> dict:
+    """Run code in a fresh interpreter and return its JSON line plus wall time"""
+    env = dict(os.environ, PYTHONPATH=REPO, PYTHONDONTWRITEBYTECODE="1")
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code, *args], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True)
+    wall_ms = (time.perf_counter() - started) * 1000
+    lines = result.stdout.strip().splitlines()
+    data = json.loads(lines[-1]) if lines else {}
+    data["wall_ms"] = wall_ms
+    return data
+
+
+def median(runs: list, key: str) -> float:
+    return statistics.median(r[key] for r in runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--max-import-ms", type=float, default=0, help="fail if `import ai` takes longer")
+    parser.add_argument("--port", type=int, default=8795)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    bare = [run("import json; print('{}')") for _ in range(args.runs)]
+    imports = [run(IMPORT_ONLY) for _ in range(args.runs)]
+    results = {"python_ms": median(bare, "wall_ms"),
+               "import_ms": median(imports, "import_ms"),
+               "import_wall_ms": median(imports, "wall_ms"),
+               "heavy_modules": imports[0]["heavy"]}
+
+    lm = FakeLMStudio(first_token=0.0, token_latency=0.0)
+    with StandIns(lm, FakeSearch(), port=args.port) as stand_ins:
+        cold, warm = [], []
+        for _ in range(args.runs):
+            workdir = tempfile.mkdtemp(prefix="testudo-startup-")
+            try:
+                probes = lm.model_requests
+                cold.append(run(CLI, stand_ins.lm_url, cwd=workdir))
+                warm.append(run(CLI, stand_ins.lm_url, cwd=workdir))
+                warm[-1]["probes"] = lm.model_requests - probes - 1
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    results.update({"cli_cold_wall_ms": median(cold, "wall_ms"),
+                    "cli_cold_reply_ms": median(cold, "reply_ms"),
+                    "cli_warm_wall_ms": median(warm, "wall_ms"),
+                    "cli_warm_reply_ms": median(warm, "reply_ms"),
+                    "warm_model_probes": sum(r["probes"] for r in warm),
+                    "cli_ok": all(r["ok"] for r in cold + warm)})
+
+    print(f"python startup            {results['python_ms']:7.1f} ms")
+    print(f"import ai                 {results['import_ms']:7.1f} ms  (heavy modules loaded: "
+          f"{', '.join(results['heavy_modules']) or 'none'})")
+    print(f"CLI, no model cache       {results['cli_cold_wall_ms']:7.1f} ms wall, "
+          f"{results['cli_cold_reply_ms']:.1f} ms to reply")
+    print(f"CLI, cached model list    {results['cli_warm_wall_ms']:7.1f} ms wall, "
+          f"{results['cli_warm_reply_ms']:.1f} ms to reply, "
+          f"{results['warm_model_probes']} /v1/models calls")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.max_import_ms and results["import_ms"] > args.max_import_ms:
+        print(f"import ai is over the {args.max_import_ms:.0f} ms budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
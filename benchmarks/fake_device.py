@@ -0,0 +1,176 @@
+"""Stand-in for the ESP32 web server in serverer.ino, for measuring without hardware
+
+Serves the same routes (/, /deneme.wav, /upload) and can throttle the link
+or drop it once mid-upload to exercise DeviceClient's retry path. Like
+handleUpload, /upload answers 400 to a body without a Content-Length
+(a chunked POST) unless firmware=False, which stands in for firmware
+that reads the request stream.
+/deneme.wav answers conditional requests, so MicIngest's 304 path can be
+exercised too.
+
+Run from the repo root:  python benchmarks/fake_device.py
+"""
+import asyncio
+import hashlib
+import io
+import os
+import sys
+import time
+import wave
+
+import numpy as np
+from aiohttp import web
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai import DeviceClient, device_wav_header, DEVICE_SAMPLE_RATE
+
+
+def mic_clip(seconds: float = 5.0, speech: tuple = (1.5, 3.0), rate: int = DEVICE_SAMPLE_RATE) -> bytes:
+    """A 16-bit mono WAV like recordToWav writes: quiet noise with a louder 'speech' stretch"""
+    rng = np.random.default_rng(0)
+    samples = rng.normal(0, 30, int(seconds * rate))
+    start, end = int(speech[0] * rate), int(speech[1] * rate)
+    t = np.arange(end - start) / rate
+    samples[start:end] += 6000 * np.sin(2 * np.pi * 220 * t) * np.sin(2 * np.pi * 3 * t) ** 2
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(np.clip(samples, -32768, 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+class FakeDevice:
+    """aiohttp app with the ESP32's routes and some link misbehaviour knobs"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080,
+                 bytes_per_second: float = 0, drop_after: int = 0, firmware: bool = True):
+        self.host = host
+        self.firmware = firmware
+        self.port = port
+        self.bytes_per_second = bytes_per_second
+        self.drop_after = drop_after
+        self.recording = mic_clip()
+        self.recorded_at = time.time()
+        self.uploads = []
+        self.rejected = 0
+        self.aborted = 0
+        self.runner = None
+
+        self.app = web.Application()
+        self.app.router.add_get("/", self.index)
+        self.app.router.add_get("/deneme.wav", self.deneme)
+        self.app.router.add_post("/upload", self.upload)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def record(self, clip: bytes):
+        """Pretend the clap detector just recorded a new clip"""
+        self.recording = clip
+        self.recorded_at = time.time()
+
+    async def index(self, request):
+        return web.Response(text=f"<h2>Web Server Running</h2><p>IP: <b>{self.host}</b></p>"
+                                 "<p><a href='/deneme.wav'>Download deneme.wav</a></p>",
+                            content_type="text/html")
+
+    async def deneme(self, request):
+        etag = '"%s"' % hashlib.sha1(self.recording).hexdigest()[:16]
+        headers = {"ETag": etag, "Last-Modified": formatdate(self.recorded_at, usegmt=True)}
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=self.recording, content_type="audio/wav", headers=headers)
+
+    async def upload(self, request):
+        if self.firmware and request.content_length is None:
+            self.rejected += 1
+            return web.Response(status=400, text="No data received")
+        start = time.perf_counter()
+        first_byte = None
+        received = bytearray()
+        try:
+            async for chunk in request.content.iter_chunked(4096):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                received += chunk
+                if self.drop_after and len(received) >= self.drop_after:
+                    self.drop_after = 0
+                    request.transport.close()
+                    return web.Response(status=503)
+                if self.bytes_per_second:
+                    await asyncio.sleep(len(chunk) / self.bytes_per_second)
+        except ConnectionResetError:
+            self.aborted += 1  # the client gave up before the last chunk
+            return web.Response(status=400)
+        self.uploads.append({"bytes": bytes(received),
+                             "first_byte": first_byte or 0.0,
+                             "seconds": time.perf_counter() - start,
+                             "chunked": request.headers.get("Transfer-Encoding") == "chunked"})
+        return web.Response(text="File received")
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+async def measure(size: int = 160_000, chunk_size: int = 4096, produce_delay: float = 0.01,
+                  chunked: bool = False, firmware: bool = True, fail: bool = False):
+    """Upload throughput and end-to-end latency against the stand-in device
+
+    With fail=True the audio stream raises halfway, like a TTS error;
+    nothing may reach the device then.
+    """
+    device = FakeDevice(port=8089, bytes_per_second=500_000, drop_after=size // 3, firmware=firmware)
+    await device.start()
+    client = DeviceClient(device.url, chunk_size=chunk_size, backoff=0.05, chunked=chunked)
+
+    async def produced_audio():
+        yield device_wav_header()
+        pcm = np.full(size, 128, dtype=np.uint8).tobytes()
+        for offset in range(0, size, 8000):
+            await asyncio.sleep(produce_delay)
+            if fail and offset >= size // 2:
+                raise RuntimeError("TTS failed")
+            yield pcm[offset:offset + 8000]
+
+    try:
+        start = time.perf_counter()
+        ok = await client.upload_stream(produced_audio())
+        elapsed = time.perf_counter() - start
+        print(f"{'chunked' if chunked else 'whole body'} upload to "
+              f"{'serverer.ino-like' if firmware else 'streaming'} firmware"
+              f"{', audio stream fails halfway' if fail else ''}:")
+        if not device.uploads:
+            await asyncio.sleep(0.1)  # let the device notice an aborted body
+            print(f"ok={ok}, device rejected {device.rejected} request(s), "
+                  f"{device.aborted} aborted mid-body")
+            return
+        upload = device.uploads[-1]
+        print(f"ok={ok} bytes={len(upload['bytes'])} chunked={upload['chunked']} retries={client.stats['retries']}")
+        print(f"end-to-end {elapsed * 1000:.0f} ms, first byte at device {upload['first_byte'] * 1000:.1f} ms "
+              f"into the request, {client.stats['last_bytes_per_second'] / 1024:.0f} KiB/s")
+    finally:
+        await client.aclose()
+        await device.stop()
+
+
+async def main():
+    await measure()
+    await measure(chunked=True)
+    await measure(chunked=True, firmware=False)
+    await measure(fail=True)
+    await measure(chunked=True, firmware=False, fail=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())